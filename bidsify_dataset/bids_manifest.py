@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+
+from compression import BUFFER_SIZE, compress_file
+
+# conversion manifest of bidsify_dataset.py
+# the BIDS folder keeps a sidecar manifest (.bidsify_manifest.json) with one record per converted file:
+# the raw file it was converted from, its size and mtime and (optionally) its sha256. In update mode, a file is only
+# converted again if its raw file is new or changed, or the converted file is missing.
+
+MANIFEST_NAME = '.bidsify_manifest.json'
+
+
+def file_signature(path):
+    '''
+    :param path: path to a file
+    :return: return the [size, mtime (ns)] of the file
+    '''
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def file_hash(path):
+    '''
+    :param path: path to a file
+    :return: return the sha256 of the file as hex string
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(BUFFER_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def load_manifest(filename):
+    '''
+    :param filename: path to the manifest .json file
+    :return: return the manifest as dictionary (empty if the file does not exist)
+    '''
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(filename, manifest):
+    '''
+    This function writes the manifest to a temporary file and renames it, so a crash never leaves a truncated manifest
+    '''
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def update_file(raw, bids, record, level=6, threads=1, use_hash=False):
+    '''
+    This function converts a raw file unless it did not change since it was recorded in the manifest
+
+    :param raw: path to the raw (uncompressed) file
+    :param bids: path to the compressed file in the BIDS folder
+    :param record: manifest record of the file from a previous run (None if there is none)
+    :param level: compression level
+    :param threads: number of threads compressing one file
+    :param use_hash: compare the sha256 of the raw file if its size or mtime changed
+    :return: return the new manifest record and the result of compress_file (None if the file was skipped)
+    '''
+    raw = os.path.abspath(raw)
+    size, mtime = file_signature(raw)
+    if record is not None and record['source'] == raw and os.path.exists(bids):
+        if [record['size'], record['mtime_ns']] == [size, mtime]:
+            return record, None
+        if use_hash and record.get('sha256') is not None and record['sha256'] == file_hash(raw):
+            # same content, e.g. copied again with a new mtime
+            return {**record, 'size': size, 'mtime_ns': mtime}, None
+    checksum = hashlib.sha256() if use_hash else None
+    result = compress_file(raw, bids, level, threads, checksum=checksum)
+    return {'source': raw, 'size': size, 'mtime_ns': mtime,
+            'sha256': checksum.hexdigest() if checksum is not None else None}, result
@@ -1,138 +1,186 @@
 import argparse
 import os
 import json
-import gzip
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 
-parser = argparse.ArgumentParser(description='Convert database to BIDS convention.')
-parser.add_argument('-i', '--input_directory', help='Folder of database.', required=True)
-parser.add_argument('-o','--output_directory', help='Folder of bids database', required=True)
-
-args = parser.parse_args()
-mode = 0o777
-
-# create a new folder in the top directory
-raw_database_dir = os.path.dirname(args.input_directory)
-raw_database_name = os.path.basename(args.input_directory)
-bids_database_name = raw_database_name + "_bids"
-bids_database_path = os.path.join(os.path.abspath(args.output_directory),bids_database_name)
-
-# BIDS file-format structure
-T1w_bidslabel = 'T1w'
-FLAIR_bidslabel = 'FLAIR'
-
-# define LICENSE
-license = "MIT"
-
-try:
-    # create BIDS top directory structure
-    os.mkdir(bids_database_path, mode)
-
-except OSError as exc:
-    raise ValueError('Error making new BIDS directory. Abort.')
-
-# @TODO: create extensive dataset description
-#  https://bids-specification.readthedocs.io/en/stable/03-modality-agnostic-files.html
-
-dictionary ={
-  "Name": "SNP-Project_Brain_Dataset",
-  "BIDSVersion": "1.7.0",
-  "DatasetType": "raw",
-  "License": "CC0",
-  "Authors": [
-    "Mark Muehlau",
-    "Tun Wiltgen",
-    "Julian McGinnis",
-  ],
-  "Acknowledgements": "",
-  "HowToAcknowledge": "",
-  "Funding": [
-    "",
-    ""
-  ],
-  "EthicsApprovals": [
-    ""
-  ],
-  "ReferencesAndLinks": [
-    "",
-    ""
-  ],
-  "DatasetDOI": "",
-  "HEDVersion": "",
-  "GeneratedBy": [
-    {
-      "Name": "jqmcginnis",
-      "Version": "0.0.1",
-    }
-  ],
-  "SourceDatasets": [
-    {
-      "URL": "",
-      "Version": "January 31 2023"
-    }
-  ]
-}
-
-# only subdirectories, files excluded
-dirs = [name for name in os.listdir(args.input_directory) if os.path.isdir(os.path.join(args.input_directory, name))]
-dirs = sorted(dirs)
-print(dirs)
-
-# declare arrays for participants.csv
-sub_array = []
-ses_array = []
-
-for id in dirs:
-    patient_id = str(id).replace("m_","m")
-    patient_path = os.path.join(args.input_directory, id)
-    print('Patient ID:', patient_id)
-    bids_subdir = str("sub-"+patient_id)
-    bids_subdir_path = os.path.join(bids_database_path,bids_subdir)
+from compression import throughput_report
+from bids_manifest import MANIFEST_NAME, load_manifest, save_manifest, update_file
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Convert database to BIDS convention.')
+    parser.add_argument('-i', '--input_directory', help='Folder of database.', required=True)
+    parser.add_argument('-o','--output_directory', help='Folder of bids database', required=True)
+    parser.add_argument('-n', '--number_of_workers', help='Number of files compressed in parallel.', type=int, default=os.cpu_count())
+    parser.add_argument('--compression_level', help='gzip compression level (1: fastest, 9: smallest).', type=int, default=6,
+                        choices=range(1, 10))
+    parser.add_argument('--threads_per_file', help='Number of threads compressing blocks of one file in parallel (output stays a standard .nii.gz).',
+                        type=int, default=1)
+    parser.add_argument('--update', action='store_true',
+                        help='Update an existing bids database: only convert new or changed files and merge participants.csv.')
+    parser.add_argument('--hash', action='store_true',
+                        help='In update mode, compare the sha256 of raw files whose size or mtime changed (recorded in .bidsify_manifest.json).')
+
+    args = parser.parse_args()
+    mode = 0o777
+
+    # create a new folder in the top directory
+    raw_database_dir = os.path.dirname(args.input_directory)
+    raw_database_name = os.path.basename(args.input_directory)
+    bids_database_name = raw_database_name + "_bids"
+    bids_database_path = os.path.join(os.path.abspath(args.output_directory),bids_database_name)
+
+    # BIDS file-format structure
+    T1w_bidslabel = 'T1w'
+    FLAIR_bidslabel = 'FLAIR'
+
+    # define LICENSE
+    license = "MIT"
+
     try:
-        os.mkdir(bids_subdir_path)
-    except:
-        raise ValueError('Error making new directories. Abort.')
-
-    session_dirs = [name for name in os.listdir(patient_path) if os.path.isdir(os.path.join(patient_path, name))]
-
-    for session in session_dirs:
-        session_id = 'ses-'+session.replace("-", "")
-        sub_array.append(bids_subdir)
-        ses_array.append(session_id)
-        # assert proper date format
-        session_path = os.path.join(patient_path, session)
-        bids_session_path = os.path.join(bids_subdir_path, session_id)
-        bids_session_path_anat = os.path.join(bids_session_path,'anat')
-        print(bids_session_path)
-        print(session_path)
-        try:
-            os.mkdir(bids_session_path)
-            os.mkdir(bids_session_path_anat)
+        # create BIDS top directory structure (in update mode, an existing one is used)
+        os.makedirs(bids_database_path, mode, exist_ok=args.update)
+
+    except OSError as exc:
+        raise ValueError('Error making new BIDS directory (use --update to update an existing one). Abort.')
+
+    # @TODO: create extensive dataset description
+    #  https://bids-specification.readthedocs.io/en/stable/03-modality-agnostic-files.html
+
+    dictionary ={
+      "Name": "SNP-Project_Brain_Dataset",
+      "BIDSVersion": "1.7.0",
+      "DatasetType": "raw",
+      "License": "CC0",
+      "Authors": [
+        "Mark Muehlau",
+        "Tun Wiltgen",
+        "Julian McGinnis",
+      ],
+      "Acknowledgements": "",
+      "HowToAcknowledge": "",
+      "Funding": [
+        "",
+        ""
+      ],
+      "EthicsApprovals": [
+        ""
+      ],
+      "ReferencesAndLinks": [
+        "",
+        ""
+      ],
+      "DatasetDOI": "",
+      "HEDVersion": "",
+      "GeneratedBy": [
+        {
+          "Name": "jqmcginnis",
+          "Version": "0.0.1",
+        }
+      ],
+      "SourceDatasets": [
+        {
+          "URL": "",
+          "Version": "January 31 2023"
+        }
+      ]
+    }
 
+    # only subdirectories, files excluded
+    dirs = [name for name in os.listdir(args.input_directory) if os.path.isdir(os.path.join(args.input_directory, name))]
+    dirs = sorted(dirs)
+    print(dirs)
+
+    # declare arrays for participants.csv
+    sub_array = []
+    ses_array = []
+    # (raw, bids) paths of the files to compress
+    compression_jobs = []
+
+    for id in dirs:
+        patient_id = str(id).replace("m_","m")
+        patient_path = os.path.join(args.input_directory, id)
+        print('Patient ID:', patient_id)
+        bids_subdir = str("sub-"+patient_id)
+        bids_subdir_path = os.path.join(bids_database_path,bids_subdir)
+        try:
+            os.makedirs(bids_subdir_path, exist_ok=args.update)
         except:
             raise ValueError('Error making new directories. Abort.')
-            
-        t1w_raw = os.path.join(session_path, "t1.nii")
-        t1w_bids = os.path.join(bids_session_path_anat, f"sub-{patient_id}_{session_id}_{T1w_bidslabel}.nii.gz")
-        f2w_raw = os.path.join(session_path, "f2.nii")
-        f2w_bids = os.path.join(bids_session_path_anat, f"sub-{patient_id}_{session_id}_{FLAIR_bidslabel}.nii.gz")
 
-        raw_dirs = [t1w_raw, f2w_raw]
-        bids_dirs = [t1w_bids,f2w_bids]
-
-        for raw,bids in zip(raw_dirs,bids_dirs):
+        session_dirs = [name for name in os.listdir(patient_path) if os.path.isdir(os.path.join(patient_path, name))]
+
+        for session in session_dirs:
+            session_id = 'ses-'+session.replace("-", "")
+            sub_array.append(bids_subdir)
+            ses_array.append(session_id)
+            # assert proper date format
+            session_path = os.path.join(patient_path, session)
+            bids_session_path = os.path.join(bids_subdir_path, session_id)
+            bids_session_path_anat = os.path.join(bids_session_path,'anat')
+            print(bids_session_path)
+            print(session_path)
             try:
-                with open(raw, 'rb') as src, gzip.open(bids, 'wb') as dst:
-                    dst.writelines(src)
-            except:
-                raise ValueError('Error zippping nifti file. Abort.')
+                os.makedirs(bids_session_path, exist_ok=args.update)
+                os.makedirs(bids_session_path_anat, exist_ok=args.update)
 
-
-# Serializing json
-json_object = json.dumps(dictionary, indent=4)
-# write to dataset description
-with open(os.path.join(bids_database_path,"dataset_description.json"), "w") as outfile:
-    outfile.write(json_object)
-# write lists of subdirectories and session-IDs to participants.csv
-df = pd.DataFrame({"subject":sub_array, "session":ses_array})
-df.to_csv(os.path.join(bids_database_path,"participants.csv"))
+            except:
+                raise ValueError('Error making new directories. Abort.')
+            
+            t1w_raw = os.path.join(session_path, "t1.nii")
+            t1w_bids = os.path.join(bids_session_path_anat, f"sub-{patient_id}_{session_id}_{T1w_bidslabel}.nii.gz")
+            f2w_raw = os.path.join(session_path, "f2.nii")
+            f2w_bids = os.path.join(bids_session_path_anat, f"sub-{patient_id}_{session_id}_{FLAIR_bidslabel}.nii.gz")
+
+            raw_dirs = [t1w_raw, f2w_raw]
+            bids_dirs = [t1w_bids,f2w_bids]
+
+            # the files are compressed in parallel once all folders are created
+            compression_jobs += list(zip(raw_dirs, bids_dirs))
+
+    # compress the nifti files in a process pool (streamed with a fixed buffer, see compression.py),
+    # in update mode, unchanged files are skipped (see bids_manifest.py)
+    manifest_path = os.path.join(bids_database_path, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path) if args.update else {}
+    start = time.perf_counter()
+    results = []
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, args.number_of_workers // args.threads_per_file)) as executor:
+            futures = {executor.submit(update_file, raw, bids, manifest.get(os.path.relpath(bids, bids_database_path)),
+                                       args.compression_level, args.threads_per_file, args.hash): (raw, bids)
+                       for raw, bids in compression_jobs}
+            for future in as_completed(futures):
+                raw, bids = futures[future]
+                try:
+                    record, result = future.result()
+                except Exception as e:
+                    # the queued files are not compressed any more, only the running ones are waited for
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise ValueError(f'Error zipping nifti file {raw}: {e}. Abort.')
+                manifest[os.path.relpath(bids, bids_database_path)] = record
+                if result is not None:
+                    results.append(result)
+                    # save the progress regularly, so that an interrupted run can be resumed with --update
+                    if len(results) % 100 == 0:
+                        save_manifest(manifest_path, manifest)
+    finally:
+        save_manifest(manifest_path, manifest)
+    print(f'{len(compression_jobs) - len(results)} unchanged files skipped')
+    print(throughput_report(results, time.perf_counter() - start))
+
+    # Serializing json
+    json_object = json.dumps(dictionary, indent=4)
+    # write to dataset description (an existing one is kept in update mode)
+    if not (args.update and os.path.exists(os.path.join(bids_database_path,"dataset_description.json"))):
+        with open(os.path.join(bids_database_path,"dataset_description.json"), "w") as outfile:
+            outfile.write(json_object)
+    # write lists of subdirectories and session-IDs to participants.csv
+    # (in update mode, the new sessions are appended to the existing ones)
+    participants_path = os.path.join(bids_database_path,"participants.csv")
+    df = pd.DataFrame({"subject":sub_array, "session":ses_array})
+    if args.update and os.path.exists(participants_path):
+        df = pd.concat([pd.read_csv(participants_path, index_col=0), df]).drop_duplicates(["subject", "session"]).reset_index(drop=True)
+    df.to_csv(participants_path + ".tmp")
+    os.replace(participants_path + ".tmp", participants_path)
@@ -0,0 +1,103 @@
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# gzip compression helpers for bidsify_dataset.py
+# files are streamed with a fixed (large) buffer. With threads > 1, the file is split into blocks that are deflated
+# in parallel (zlib releases the GIL) and written as one standard gzip member, like pigz: every block but the last
+# ends with a sync flush, so the blocks can simply be concatenated. The crc32 is computed over the whole file.
+# The output is written to a temporary file that is renamed when complete, so a crash never leaves a truncated file.
+
+BUFFER_SIZE = 16 * 1024 ** 2
+BLOCK_SIZE = 4 * 1024 ** 2
+
+
+def gzip_header(level, mtime=0):
+    '''
+    :param level: compression level (stored as hint in the header)
+    :param mtime: modification time stored in the header (0: none)
+    :return: return the 10 byte gzip header
+    '''
+    xfl = 2 if level == 9 else 4 if level == 1 else 0
+    return struct.pack('<BBBBLBB', 0x1f, 0x8b, 8, 0, int(mtime), xfl, 255)
+
+
+def _deflate_block(data, level, last):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def compress_file(src, dst, level=6, threads=1, buffer_size=BUFFER_SIZE, block_size=BLOCK_SIZE, checksum=None):
+    '''
+    This function compresses a file to a standard .gz file
+
+    :param src: path to the uncompressed file
+    :param dst: path to the compressed file
+    :param level: compression level (1: fastest, 9: smallest)
+    :param threads: number of threads compressing blocks of the file in parallel (1: stream with a single compressor)
+    :param buffer_size: size of the read buffer in bytes (single compressor)
+    :param block_size: size of the blocks compressed in parallel in bytes
+    :param checksum: hashlib object updated with the uncompressed data (optional)
+    :return: return the size of the uncompressed and of the compressed file in bytes and the runtime in s
+    '''
+    start = time.perf_counter()
+    crc = 0
+    size = 0
+    tmp = dst + '.tmp'
+    try:
+        with open(src, 'rb') as fin, open(tmp, 'wb') as fout:
+            fout.write(gzip_header(level))
+            if threads <= 1:
+                compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+                while True:
+                    data = fin.read(buffer_size)
+                    if not data:
+                        break
+                    crc = zlib.crc32(data, crc)
+                    if checksum is not None:
+                        checksum.update(data)
+                    size += len(data)
+                    fout.write(compressor.compress(data))
+                fout.write(compressor.flush())
+            else:
+                with ThreadPoolExecutor(max_workers=threads) as executor:
+                    pending = []
+                    data = fin.read(block_size)
+                    while True:
+                        following = fin.read(block_size)
+                        crc = zlib.crc32(data, crc)
+                        if checksum is not None:
+                            checksum.update(data)
+                        size += len(data)
+                        pending.append(executor.submit(_deflate_block, data, level, not following))
+                        # at most 2 blocks per thread are held in memory
+                        while len(pending) >= 2 * threads or (pending and not following):
+                            fout.write(pending.pop(0).result())
+                        if not following:
+                            break
+                        data = following
+            fout.write(struct.pack('<LL', crc & 0xffffffff, size & 0xffffffff))
+            compressed_size = fout.tell()
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return size, compressed_size, time.perf_counter() - start
+
+
+def throughput_report(results, wall_time):
+    '''
+    :param results: list of (uncompressed size, compressed size, runtime) tuples of the compressed files
+    :param wall_time: total runtime in s
+    :return: return the report as string
+    '''
+    size = sum(x[0] for x in results)
+    compressed_size = sum(x[1] for x in results)
+    wall_time = max(wall_time, 1e-9)
+    return (f'compressed {len(results)} files, {size / 1024 ** 2:.1f} MB -> {compressed_size / 1024 ** 2:.1f} MB '
+            f'(ratio {compressed_size / max(size, 1):.2f}) in {wall_time:.1f} s: '
+            f'{size / 1024 ** 2 / wall_time:.1f} MB/s, {len(results) / wall_time:.2f} files/s '
+            f'(sum of the per-file times: {sum(x[2] for x in results):.1f} s)')
@@ -0,0 +1,260 @@
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from samseg_stats import generate_samseg_stats
+
+# Benchmark of generate_samseg_stats on synthetic lesion phantoms
+# every case is a pair of SAMSEG-like label volumes (baseline/follow-up, lesions labelled 99) with a known number of
+# stable, new, enlarging (ring around the baseline lesion), shrinking and disappearing lesions, for several
+# resolutions (1 mm 256^3, 0.8 mm, anisotropic) and lesion burdens. The phantoms are generated with a fixed seed (and
+# kept in --phantom_directory), so the results of different commits can be compared. Every case runs in a fresh
+# process: wall time (best and median of --repeats calls), peak memory (maximum RSS of the process, and the increase
+# over the RSS before the first call) and correctness (lesion counts and volumes against the ground truth).
+#
+# usage: python benchmark_lesions.py --suite full -o lesions_<commit>.csv --compare lesions_<previous commit>.csv
+
+LESION_LABEL = 99
+LESION_TYPES = ['stable', 'new', 'enlarging', 'shrinking', 'disappearing']
+
+# (name, voxel size in mm, shape)
+RESOLUTIONS = {'1mm': ((1.0, 1.0, 1.0), (256, 256, 256)),
+               '0.8mm': ((0.8, 0.8, 0.8), (320, 320, 320)),
+               'aniso': ((1.0, 1.0, 2.0), (256, 256, 128))}
+SUITES = {'quick': [('1mm', n, '.mgz') for n in [0, 50, 200]],
+          'full': [(r, n, '.mgz') for r in RESOLUTIONS for n in [0, 50, 200, 500]] + [('1mm', 200, '.nii.gz')]}
+
+
+def place_lesions(number_of_lesions, spacing, shape, rng):
+    '''
+    This function places non-touching spherical lesions inside the white matter of the phantom
+
+    :param number_of_lesions: number of lesions
+    :param spacing: voxel size in mm
+    :param shape: shape of the volume
+    :param rng: numpy random generator
+    :return: return a list of (type, center in mm, outer radius in mm, inner radius in mm)
+    '''
+    # lesion sizes follow the finest axis, ring thickness and the distances between lesions the coarsest one
+    s, S, gap = min(spacing), max(spacing), 2 * max(spacing) + min(spacing)
+    extent = np.array(shape) * np.array(spacing)
+    lesions = []
+    centers = np.zeros((0, 3))
+    radii = np.zeros(0)
+    for i in range(number_of_lesions):
+        kind = LESION_TYPES[i % len(LESION_TYPES)]
+        if kind in ('enlarging', 'shrinking'):
+            # a ring of two voxels around the smaller lesion, so it encloses a hole along every axis
+            inner = max(rng.uniform(2, 3) * s, 1.5 * S)
+            outer = inner + 2 * S
+        else:
+            # generate_samseg_stats requires a maximum distance to the border (in mm) of 1.1 times the voxel volume
+            outer = max(rng.uniform(2, 3.5) * s, 1.1 * np.prod(spacing) + S)
+            inner = 0.0
+        for _ in range(10000):
+            # inside an ellipsoid of 37% of the field of view (white matter)
+            center = extent / 2 + (rng.uniform(-1, 1, 3) * 0.37 * extent)
+            if np.sum(((center - extent / 2) / (0.37 * extent)) ** 2) > 1:
+                continue
+            # enough space between two lesions, so they are neither merged nor overlap when dilated
+            if np.all(np.linalg.norm(centers - center, axis=1) > radii + outer + gap):
+                break
+        else:
+            raise ValueError(f'could not place {number_of_lesions} lesions')
+        lesions.append((kind, center, outer, inner))
+        centers = np.vstack([centers, center])
+        radii = np.append(radii, outer)
+    return lesions
+
+
+def create_phantom(path, resolution, number_of_lesions, extension='.mgz', seed=0):
+    '''
+    This function writes the baseline and follow-up segmentation of a phantom (if they do not exist yet)
+
+    :param path: folder of the phantom
+    :param resolution: key of RESOLUTIONS
+    :param number_of_lesions: number of lesions (distributed evenly over LESION_TYPES)
+    :param extension: '.mgz' or '.nii.gz'
+    :param seed: seed of the lesion placement
+    :return: return the paths of the baseline and follow-up segmentation and the ground truth
+    '''
+    spacing, shape = RESOLUTIONS[resolution]
+    case = f'{resolution.replace(".", "")}n{number_of_lesions}{extension.replace(".", "")}'
+    bl_path = os.path.join(path, f'sub-{case}_ses-1_seg{extension}')
+    fu_path = os.path.join(path, f'sub-{case}_ses-2_seg{extension}')
+    lesions = place_lesions(number_of_lesions, spacing, shape, np.random.default_rng(seed))
+    truth = {kind: sum(x[0] == kind for x in lesions) for kind in LESION_TYPES}
+    if os.path.exists(bl_path) and os.path.exists(fu_path):
+        return bl_path, fu_path, truth
+
+    # brain: cortex (3) around white matter (2), ventricles (4)
+    grid = [np.arange(n)[(slice(None),) + (None,) * (2 - i)] * spacing[i] for i, n in enumerate(shape)]
+    extent = np.array(shape) * np.array(spacing)
+    radius = sum(((g - e / 2) / (0.45 * e)) ** 2 for g, e in zip(grid, extent))
+    baseline = np.zeros(shape, dtype=np.int32)
+    baseline[radius <= 1] = 3
+    baseline[radius <= 0.85] = 2
+    ventricles = sum(((g - e / 2) / (f * e)) ** 2 for g, e, f in zip(grid, extent, (0.05, 0.15, 0.08)))
+    baseline[ventricles <= 1] = 4
+    followup = baseline.copy()
+
+    for kind, center, outer, inner in lesions:
+        # draw inside the bounding box of the lesion
+        box = tuple(slice(max(int((c - outer) / d) - 1, 0), min(int((c + outer) / d) + 2, n))
+                    for c, d, n in zip(center, spacing, shape))
+        distance = np.sqrt(sum((g[b] - c) ** 2 for g, b, c in zip(grid, box, center)))
+        big, small = distance <= outer, distance <= inner
+        if kind in ('stable', 'disappearing', 'shrinking'):
+            baseline[box][big] = LESION_LABEL
+        if kind in ('stable', 'new', 'enlarging'):
+            followup[box][big] = LESION_LABEL
+        if kind == 'enlarging':
+            baseline[box][small] = LESION_LABEL
+        if kind == 'shrinking':
+            followup[box][small] = LESION_LABEL
+
+    affine = np.diag(list(spacing) + [1.0])
+    affine[:3, 3] = -extent / 2
+    os.makedirs(path, exist_ok=True)
+    for data, filename in [(baseline, bl_path), (followup, fu_path)]:
+        img = nib.MGHImage(data, affine) if extension == '.mgz' else nib.Nifti1Image(data, affine)
+        nib.save(img, filename)
+    return bl_path, fu_path, truth
+
+
+def expected_stats(bl_path, fu_path, truth):
+    '''
+    :return: return the expected values of the lesion csv of a phantom (counts from the ground truth, volumes from
+             the lesion voxels, all lesions are larger than the default min_size)
+    '''
+    img = nib.load(bl_path)
+    baseline = np.asanyarray(img.dataobj) == LESION_LABEL
+    followup = np.asanyarray(nib.load(fu_path).dataobj) == LESION_LABEL
+    voxelsize = np.prod(np.sum(img.affine[:3, :3] ** 2, axis=0) ** 0.5)
+    bl_les = truth['stable'] + truth['enlarging'] + truth['shrinking'] + truth['disappearing']
+    return {'bl_les': bl_les,
+            'bl_vol_les': np.count_nonzero(baseline) * voxelsize,
+            'fu_les': truth['stable'] + truth['new'] + truth['enlarging'] + truth['shrinking'],
+            'fu_les_eff': bl_les + truth['new'] - truth['disappearing'],
+            'fu_vol_les': np.count_nonzero(followup) * voxelsize,
+            'fu_min_bl_les': truth['new'] + truth['enlarging'],
+            'fu_min_bl_vol_les': np.count_nonzero(followup & ~baseline) * voxelsize,
+            'bl_min_fu_les': truth['shrinking'] + truth['disappearing'],
+            'bl_min_fu_vol_les': np.count_nonzero(baseline & ~followup) * voxelsize}
+
+
+def peak_memory_mb():
+    '''
+    :return: return the peak resident memory of this process in MB (VmHWM, the maximum RSS of ru_maxrss is inherited
+             from the parent across exec on Linux, so it is only used if /proc is not available)
+    '''
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(bl_path, fu_path, repeats, save_images, results):
+    '''
+    This function runs generate_samseg_stats on a phantom (in a fresh process) and puts the timings, the memory and
+    the resulting lesion csv into the results queue
+    '''
+    rss_before = peak_memory_mb()
+    times = []
+    with tempfile.TemporaryDirectory() as output_path:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                generate_samseg_stats(bl_path, fu_path, output_path, save_images=save_images)
+            times.append(time.perf_counter() - start)
+        csv = [x for x in os.listdir(output_path) if x.endswith('_longi_lesions.csv')][0]
+        stats = pd.read_csv(os.path.join(output_path, csv)).iloc[0].to_dict()
+    results.put({'times': times, 'rss_before_mb': rss_before, 'peak_rss_mb': peak_memory_mb(), 'stats': stats})
+
+
+def commit_id():
+    '''
+    :return: return the git commit of the repository (with -dirty for uncommitted changes), or 'unknown'
+    '''
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark generate_samseg_stats on synthetic lesion phantoms.')
+    parser.add_argument('--suite', help='Set of cases: quick (1 mm, up to 200 lesions) or full (all resolutions, up to 500 lesions).',
+                        choices=list(SUITES), default='quick')
+    parser.add_argument('--repeats', help='Number of calls per case (best and median are reported).', type=int, default=3)
+    parser.add_argument('--no_images', action='store_true', help='Do not write the lesion label maps (save_images=False).')
+    parser.add_argument('--phantom_directory', help='Folder the phantoms are kept in (default: temporary folder, removed afterwards).', default=None)
+    parser.add_argument('-o', '--output', help='Results .csv file.', default=None)
+    parser.add_argument('--compare', help='Results .csv file of another commit to compare with.', default=None)
+
+    args = parser.parse_args()
+
+    # a fresh (spawned) process per case, so the peak memory of a case is not inflated by the previous ones
+    context = multiprocessing.get_context('spawn')
+    commit = commit_id()
+    rows = []
+    with contextlib.ExitStack() as stack:
+        phantom_directory = args.phantom_directory or stack.enter_context(tempfile.TemporaryDirectory())
+        for resolution, number_of_lesions, extension in SUITES[args.suite]:
+            start = time.perf_counter()
+            bl_path, fu_path, truth = create_phantom(phantom_directory, resolution, number_of_lesions, extension)
+            expected = expected_stats(bl_path, fu_path, truth)
+            print(f'{resolution} {number_of_lesions} lesions {extension}: phantom ready in {time.perf_counter() - start:.1f} s', flush=True)
+
+            results = context.Queue()
+            process = context.Process(target=run_case, args=(bl_path, fu_path, args.repeats, not args.no_images, results))
+            process.start()
+            result = results.get()
+            process.join()
+
+            errors = [f'{x}: {result["stats"][x]:g} != {expected[x]:g}' for x in expected
+                      if not np.isclose(result['stats'][x], expected[x], rtol=1e-9)]
+            spacing, shape = RESOLUTIONS[resolution]
+            rows.append({'commit': commit, 'case': f'{resolution}_n{number_of_lesions}{extension}', 'resolution': resolution,
+                         'shape': 'x'.join(map(str, shape)), 'format': extension, 'lesions': number_of_lesions,
+                         'images': not args.no_images, 'repeats': args.repeats,
+                         'best_s': min(result['times']), 'median_s': float(np.median(result['times'])),
+                         'peak_rss_mb': result['peak_rss_mb'], 'peak_increase_mb': result['peak_rss_mb'] - result['rss_before_mb'],
+                         'correct': not errors, 'errors': '; '.join(errors)})
+            row = rows[-1]
+            print(f'  best {row["best_s"]:.2f} s, median {row["median_s"]:.2f} s, peak RSS {row["peak_rss_mb"]:.0f} MB '
+                  f'(+{row["peak_increase_mb"]:.0f} MB), {"correct" if row["correct"] else "WRONG: " + row["errors"]}', flush=True)
+
+    table = pd.DataFrame(rows)
+    table['python'] = platform.python_version()
+    table['numpy'] = np.__version__
+    table['host'] = platform.node()
+    if args.output:
+        table.to_csv(args.output, index=False)
+    if args.compare:
+        previous = pd.read_csv(args.compare).set_index('case')
+        print(f'\ncompared with {previous["commit"].iloc[0]} (ratio < 1: faster/smaller now)')
+        for row in rows:
+            if row['case'] in previous.index:
+                old = previous.loc[row['case']]
+                print(f'{row["case"]:>20}: time {row["best_s"] / old["best_s"]:.2f}x, '
+                      f'memory {row["peak_increase_mb"] / max(old["peak_increase_mb"], 1):.2f}x'
+                      + ('' if row['correct'] == old['correct'] else f', correct: {old["correct"]} -> {row["correct"]}'))
+    if not all(row['correct'] for row in rows):
+        raise SystemExit('some cases were not classified correctly')
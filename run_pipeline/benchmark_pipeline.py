@@ -0,0 +1,164 @@
+import argparse
+import glob
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from benchmark_lesions import commit_id
+from fake_toolchain import create_bids_tree, create_fake_toolchain
+
+# End-to-end benchmark of the orchestration of run_pipeline.py with the fake toolchain (see fake_toolchain.py)
+# for every cohort size, a BIDS tree with N subjects (two sessions with T1w and FLAIR) is generated and the real
+# run_pipeline.py is run on it, the fake tools only sleep for their (scaled) runtime. From the stage events of the
+# subjects (see events.py) it reports the scheduling efficiency (makespan compared to the ideal makespan of the
+# measured subject runtimes on the workers, idle time of the workers, gap between two subjects of a worker, time
+# before the first and after the last subject), the cost of the fan-out stages and the throughput of the stats stage.
+#
+# usage: python benchmark_pipeline.py --subjects 10 100 1000 -n 8 -o pipeline_<commit>.csv --compare pipeline_<previous commit>.csv
+
+DERIVATIVES = os.path.join('derivatives', 'samseg-longitudinal-7.3.2')
+# runtime of the fake tools in seconds (roughly the proportions of the real tools)
+DELAYS = {'mri_robust_template': 0.3, 'mri_coreg': 0.1, 'mri_vol2vol': 0.05, 'run_samseg_long': 2.0, 'siena': 0.6}
+# tool run by each stage (stage names without the _<i> suffix)
+STAGE_TOOLS = {'template': 'mri_robust_template', 'coreg': 'mri_coreg', 'vol2vol': 'mri_vol2vol',
+               'samseg': 'run_samseg_long', 'siena': 'siena'}
+
+
+def read_events(derivatives_dir):
+    '''
+    :param derivatives_dir: samseg derivatives folder
+    :return: return the stage events of all subjects (without the skipped stages) with start and end as timestamps
+    '''
+    events = []
+    for filename in glob.glob(os.path.join(derivatives_dir, 'sub-*', 'sub-*_events.jsonl')):
+        with open(filename, 'r') as f:
+            events += [json.loads(line) for line in f if line.strip()]
+    df = pd.DataFrame(events)
+    df = df[df['status'] != 'skipped'].copy()
+    df['start'] = pd.to_datetime(df['start'])
+    df['end'] = df['start'] + pd.to_timedelta(df['wall'], unit='s')
+    df['stage_type'] = df['stage'].str.replace(r'_\d+$', '', regex=True)
+    return df
+
+
+def scheduling_metrics(events, number_of_workers, started, finished, delays):
+    '''
+    This function computes the scheduling efficiency, the fan-out cost and the stats throughput of a run
+
+    :param events: stage events (see read_events)
+    :param number_of_workers: number of workers of the run
+    :param started: time run_pipeline.py was started
+    :param finished: time run_pipeline.py finished
+    :param delays: runtime of the fake tools in seconds
+    :return: return a dictionary of metrics
+    '''
+    subjects = events.groupby('subject').agg(start=('start', 'min'), end=('end', 'max'), worker=('worker', 'first'))
+    subjects['duration'] = (subjects['end'] - subjects['start']).dt.total_seconds()
+    first, last = subjects['start'].min(), subjects['end'].max()
+    busy = subjects['duration'].sum()
+    makespan = (finished - started).total_seconds()
+    # lower bound of the makespan: the measured subjects spread perfectly over the workers
+    ideal = max(busy / number_of_workers, subjects['duration'].max())
+    gaps = []
+    for _, x in subjects.sort_values('start').groupby('worker'):
+        gaps += list((x['start'].iloc[1:].values - x['end'].iloc[:-1].values) / np.timedelta64(1, 's'))
+    # time the stages of the tools take on top of the runtime of the fake tools (process start, waiting for a core)
+    tools = events[events['stage_type'].isin(STAGE_TOOLS)]
+    tool_overhead = (tools['wall'] - tools['stage_type'].map(lambda x: delays[STAGE_TOOLS[x]])).mean()
+    fanout = events[events['stage_type'].str.startswith('fanout')]
+    stats = events[events['stage_type'] == 'stats']
+    return {'makespan_s': makespan,
+            'ideal_s': ideal,
+            'efficiency': ideal / makespan,
+            'startup_s': (first - started).total_seconds(),
+            'shutdown_s': (finished - last).total_seconds(),
+            'idle_pct': 100 * (1 - busy / (number_of_workers * (last - first).total_seconds())),
+            'dispatch_gap_ms': 1000 * np.mean(gaps) if gaps else 0.0,
+            'subject_mean_s': subjects['duration'].mean(),
+            'tool_overhead_ms': 1000 * tool_overhead,
+            'fanout_ms_per_subject': 1000 * fanout['wall'].sum() / len(subjects),
+            'fanout_mb_per_subject': fanout['bytes'].sum() / 1024 ** 2 / len(subjects),
+            'stats_ms_per_subject': 1000 * stats['wall'].mean(),
+            'stats_subjects_per_s': len(stats) / stats['wall'].sum()}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the orchestration of run_pipeline.py with the fake toolchain.')
+    parser.add_argument('--subjects', help='Cohort sizes.', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('-n', '--number_of_workers', help='Number of subjects processed in parallel.', type=int, default=os.cpu_count())
+    parser.add_argument('--delay', dest='delays', nargs='+', default=[], metavar='TOOL=SECONDS',
+                        help=f'Runtime of a fake tool (default: {" ".join(f"{x}={y}" for x, y in DELAYS.items())}).')
+    parser.add_argument('--pipeline_args', help='Additional arguments of run_pipeline.py (e.g. "--scratch-dir /tmp/scratch").', default='')
+    parser.add_argument('--work_directory', help='Folder of the fake toolchain, the BIDS trees and the logs (default: temporary folder, removed afterwards).', default=None)
+    parser.add_argument('-o', '--output', help='Results .csv file.', default=None)
+    parser.add_argument('--compare', help='Results .csv file of another commit to compare with.', default=None)
+
+    args = parser.parse_args()
+
+    delays = dict(DELAYS)
+    for x in args.delays:
+        tool, seconds = x.split('=')
+        if tool not in DELAYS:
+            parser.error(f'unknown tool in --delay: {tool}')
+        delays[tool] = float(seconds)
+    env = dict(os.environ, **{f'FAKE_{tool.upper()}_DELAY': str(seconds) for tool, seconds in delays.items()})
+
+    commit = commit_id()
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        work_directory = args.work_directory or tmp
+        freesurfer_path, fsl_path = create_fake_toolchain(os.path.join(work_directory, 'fake'))
+        for number_of_subjects in args.subjects:
+            bids = os.path.join(work_directory, f'bids-{number_of_subjects}')
+            create_bids_tree(bids, number_of_subjects)
+            command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_pipeline.py'),
+                       '-i', bids, '-f', freesurfer_path, '-fsl', fsl_path, '-n', str(args.number_of_workers),
+                       '--cores', str(args.number_of_workers), '--threads', '1',
+                       '--memory_gb', str(args.number_of_workers), '--memory_per_subject_gb', '0.5'] + shlex.split(args.pipeline_args)
+            log = os.path.join(work_directory, f'run_pipeline-{number_of_subjects}.log')
+            print(f'{number_of_subjects} subjects, {args.number_of_workers} workers: running run_pipeline.py (log: {log})', flush=True)
+            started = datetime.now()
+            with open(log, 'w') as f:
+                returncode = subprocess.run(command, stdout=f, stderr=subprocess.STDOUT, env=env).returncode
+            finished = datetime.now()
+            if returncode != 0:
+                with open(log, 'r') as f:
+                    print(''.join(f.readlines()[-20:]))
+                raise SystemExit(f'run_pipeline.py failed with exit code {returncode}')
+
+            summary = pd.read_csv(os.path.join(bids, DERIVATIVES, 'pipeline_summary.csv'))
+            metrics = scheduling_metrics(read_events(os.path.join(bids, DERIVATIVES)), args.number_of_workers,
+                                         started, finished, delays)
+            rows.append({'commit': commit, 'subjects': number_of_subjects, 'workers': args.number_of_workers,
+                         'failed': int((~summary['success']).sum()), **metrics,
+                         'delays': ' '.join(f'{x}={y}' for x, y in delays.items()), 'pipeline_args': args.pipeline_args})
+            row = rows[-1]
+            print(f'  makespan {row["makespan_s"]:.1f} s (ideal {row["ideal_s"]:.1f} s, efficiency {row["efficiency"]:.2f}), '
+                  f'startup {row["startup_s"]:.1f} s, shutdown {row["shutdown_s"]:.1f} s, idle {row["idle_pct"]:.1f}%, '
+                  f'dispatch gap {row["dispatch_gap_ms"]:.0f} ms, tool overhead {row["tool_overhead_ms"]:.0f} ms', flush=True)
+            print(f'  fan-out {row["fanout_ms_per_subject"]:.0f} ms/subject ({row["fanout_mb_per_subject"]:.2f} MB), '
+                  f'stats {row["stats_ms_per_subject"]:.0f} ms/subject ({row["stats_subjects_per_s"]:.1f} subjects/s per worker), '
+                  f'{row["failed"]} failed', flush=True)
+
+    table = pd.DataFrame(rows)
+    if args.output:
+        table.to_csv(args.output, index=False)
+    if args.compare:
+        previous = pd.read_csv(args.compare).set_index(['subjects', 'workers'])
+        print(f'\ncompared with {previous["commit"].iloc[0]} (ratio < 1: faster now)')
+        for row in rows:
+            if (row['subjects'], row['workers']) in previous.index:
+                old = previous.loc[(row['subjects'], row['workers'])]
+                print(f'{row["subjects"]:>6} subjects: makespan {row["makespan_s"] / old["makespan_s"]:.2f}x, '
+                      f'efficiency {old["efficiency"]:.2f} -> {row["efficiency"]:.2f}, '
+                      f'fan-out {row["fanout_ms_per_subject"] / old["fanout_ms_per_subject"]:.2f}x, '
+                      f'stats {row["stats_ms_per_subject"] / old["stats_ms_per_subject"]:.2f}x')
+    if any(row['failed'] for row in rows):
+        raise SystemExit('some subjects failed, see the logs of run_pipeline.py')
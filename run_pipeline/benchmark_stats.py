@@ -0,0 +1,116 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+from utils import parse_stats
+
+# Benchmark of the stats reader of run_analysis.py: the previous pandas-based combineStats (one-row dataframe per
+# session, concatenated) against parse_stats (one dictionary per session, one dataframe built in a single call)
+# on a synthetic derivatives tree.
+#
+# usage: python benchmark_stats.py --sessions 10000
+
+# ROIs of a SAMSEG segmentation (as in _samseg.stats)
+ROIS = ['Unknown', 'Left-Cerebral-White-Matter', 'Left-Cerebral-Cortex', 'Left-Lateral-Ventricle',
+        'Left-Inf-Lat-Vent', 'Left-Cerebellum-White-Matter', 'Left-Cerebellum-Cortex', 'Left-Thalamus',
+        'Left-Caudate', 'Left-Putamen', 'Left-Pallidum', '3rd-Ventricle', '4th-Ventricle', 'Brain-Stem',
+        'Left-Hippocampus', 'Left-Amygdala', 'CSF', 'Left-Accumbens-area', 'Left-VentralDC', 'Left-vessel',
+        'Left-choroid-plexus', 'Right-Cerebral-White-Matter', 'Right-Cerebral-Cortex', 'Right-Lateral-Ventricle',
+        'Right-Inf-Lat-Vent', 'Right-Cerebellum-White-Matter', 'Right-Cerebellum-Cortex', 'Right-Thalamus',
+        'Right-Caudate', 'Right-Putamen', 'Right-Pallidum', 'Right-Hippocampus', 'Right-Amygdala',
+        'Right-Accumbens-area', 'Right-VentralDC', 'Right-vessel', 'Right-choroid-plexus', 'Optic-Chiasm',
+        'Skull', 'Soft-Nonbrain-Tissue', 'Fluid-Inside-Eyes', 'Lesions']
+
+
+def combineStats(path, subID, sesID):
+    '''
+    Previous implementation of run_analysis.combineStats (reference for the benchmark)
+    '''
+    samseg_path = os.path.join(path, "sub-"+subID, "ses-"+sesID, "anat", "sub-"+subID+"_ses-"+sesID+"_samseg.stats")
+    tiv_path = os.path.join(path, "sub-"+subID, "ses-"+sesID, "anat", "sub-"+subID+"_ses-"+sesID+"_sbtiv.stats")
+    df_samseg_stat = pd.read_csv(samseg_path, header=None, names=["ROI", "volume", "unit"])
+    df_tiv_stat = pd.read_csv(tiv_path, header=None, names=["ROI", "volume", "unit"])
+    df = pd.concat([df_samseg_stat, df_tiv_stat])
+    df["ROI"]=df["ROI"].str.replace("# Measure ","")
+    df = df.loc[:,["ROI", "volume"]].reset_index().drop("index", axis=1)
+    df = df.transpose()
+    df.columns = list(df.iloc[0,0:])
+    df = df.drop(index = 'ROI').reset_index().drop("index", axis=1)
+    df["sub-ID"] = subID
+    df["ses-ID"]= sesID
+    df_IDs=df[["sub-ID", "ses-ID"]]
+    df.drop(labels=["sub-ID", "ses-ID"], axis=1, inplace=True)
+    df.insert(0, "ses-ID", df_IDs["ses-ID"])
+    df.insert(0, "sub-ID", df_IDs["sub-ID"])
+    return df
+
+
+def create_stats_tree(path, number_of_sessions, sessions_per_subject=2, seed=0):
+    '''
+    This function writes synthetic _samseg.stats and _sbtiv.stats files
+
+    :param path: derivatives folder
+    :param number_of_sessions: total number of sessions
+    :param sessions_per_subject: number of sessions per subject
+    :return: return the list of (subject ID, session ID) tuples
+    '''
+    rng = np.random.default_rng(seed)
+    sessions = []
+    for k in range(number_of_sessions):
+        subID, sesID = f'b{k // sessions_per_subject:06d}', f'{2010 + k % sessions_per_subject}0101'
+        anat = os.path.join(path, f'sub-{subID}', f'ses-{sesID}', 'anat')
+        os.makedirs(anat, exist_ok=True)
+        prefix = os.path.join(anat, f'sub-{subID}_ses-{sesID}')
+        with open(prefix + '_samseg.stats', 'w') as f:
+            f.writelines(f'# Measure {roi}, {v:.6f}, mm^3\n' for roi, v in zip(ROIS, rng.uniform(0, 5e5, len(ROIS))))
+        with open(prefix + '_sbtiv.stats', 'w') as f:
+            f.write(f'# Measure Intra-Cranial, {rng.uniform(1.2e6, 1.8e6):.6f}, mm^3\n')
+        sessions.append((subID, sesID))
+    return sessions
+
+
+def read_with_parse_stats(path, sessions):
+    records = []
+    for subID, sesID in sessions:
+        prefix = os.path.join(path, "sub-"+subID, "ses-"+sesID, "anat", "sub-"+subID+"_ses-"+sesID)
+        records.append({"sub-ID": subID, "ses-ID": sesID,
+                        **parse_stats(prefix + "_samseg.stats"), **parse_stats(prefix + "_sbtiv.stats")})
+    return pd.DataFrame.from_records(records)
+
+
+def read_with_combine_stats(path, sessions):
+    return pd.concat([combineStats(path, subID, sesID) for subID, sesID in sessions], ignore_index=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the stats reader of run_analysis.py.')
+    parser.add_argument('--sessions', help='Number of synthetic sessions.', type=int, default=10000)
+    parser.add_argument('-o', '--output_directory', help='Folder for the synthetic tree (default: temporary folder, removed afterwards).', default=None)
+    args = parser.parse_args()
+
+    path = args.output_directory or tempfile.mkdtemp(prefix='benchmark_stats_')
+    try:
+        start = time.perf_counter()
+        sessions = create_stats_tree(path, args.sessions)
+        print(f'created {len(sessions)} sessions in {time.perf_counter() - start:.1f} s')
+
+        timings = {}
+        tables = {}
+        for name, reader in [('combineStats', read_with_combine_stats), ('parse_stats', read_with_parse_stats)]:
+            start = time.perf_counter()
+            tables[name] = reader(path, sessions)
+            timings[name] = time.perf_counter() - start
+            print(f'{name:>12}: {timings[name]:7.2f} s ({len(sessions) / timings[name]:8.0f} sessions/s)')
+        print(f'speedup: {timings["combineStats"] / timings["parse_stats"]:.1f}x')
+
+        # both readers have to give the same table (combineStats keeps the volumes as objects)
+        pd.testing.assert_frame_equal(tables['combineStats'].infer_objects(), tables['parse_stats'])
+        print('tables are identical')
+    finally:
+        if args.output_directory is None:
+            shutil.rmtree(path)
@@ -0,0 +1,174 @@
+import json
+import os
+import socket
+import threading
+import time
+
+# work claiming on a shared file system
+# several run_pipeline.py instances (on one or many nodes) process one cohort by claiming the subjects one at a time
+# through lease files in <derivatives>/claims: sub-<ID>.lease is created atomically (hardlink of a unique file, which
+# is atomic on NFS as well) by the instance processing the subject, which refreshes its mtime every heartbeat.
+# A lease that was not refreshed for lease_seconds belongs to a crashed instance and is taken over by the next
+# instance (under a short-lived sub-<ID>.reclaim lock, so only one instance takes it over). A finished subject gets
+# sub-<ID>.done with its result and is never claimed again, so every subject is processed exactly once as long as
+# the clocks of the nodes agree and no instance stalls for longer than a lease.
+
+
+def _write_json(path, content):
+    tmp = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(content, f)
+    return tmp
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class WorkClaims:
+    '''
+    Lease files of the subjects of a cohort shared by several pipeline instances (see above)
+    '''
+
+    def __init__(self, claims_dir, lease_seconds=600, heartbeat_seconds=None, owner=None):
+        '''
+        :param claims_dir: folder of the lease files (on the shared file system)
+        :param lease_seconds: time after which a lease that was not refreshed is taken over
+        :param heartbeat_seconds: interval at which the leases are refreshed (default: a quarter of the lease)
+        :param owner: name of this instance (default: host name and process ID)
+        '''
+        self.claims_dir = claims_dir
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds or lease_seconds / 4
+        self.owner = owner or f'{socket.gethostname()}-{os.getpid()}'
+        self.held = set()
+        self.lost = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(claims_dir, exist_ok=True)
+
+    def _path(self, subject, kind):
+        return os.path.join(self.claims_dir, f'{subject}.{kind}')
+
+    def _expired(self, path):
+        try:
+            return time.time() - os.stat(path).st_mtime > self.lease_seconds
+        except FileNotFoundError:
+            return True
+
+    def _create(self, path, content):
+        # create the file atomically: hardlink a complete unique file to the name, fails if the name exists
+        tmp = _write_json(path, content)
+        try:
+            os.link(tmp, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp)
+
+    def done(self, subject):
+        '''
+        :param subject: subject folder name (e.g. "sub-m001")
+        :return: return the result recorded for the subject, or None if it is not finished
+        '''
+        return _read_json(self._path(subject, 'done'))
+
+    def claim(self, subject):
+        '''
+        This function tries to claim a subject
+
+        :param subject: subject folder name (e.g. "sub-m001")
+        :return: return True if this instance holds the lease of the subject now
+        '''
+        if os.path.exists(self._path(subject, 'done')):
+            return False
+        lease = self._path(subject, 'lease')
+        content = {'owner': self.owner, 'claimed': time.time()}
+        if not self._create(lease, content):
+            if not self._expired(lease):
+                return False
+            # take over the expired lease of a crashed instance, only one instance may do this at a time
+            reclaim = self._path(subject, 'reclaim')
+            if self._expired(reclaim) and os.path.exists(reclaim):
+                # left by an instance that crashed while taking over
+                os.remove(reclaim)
+            if not self._create(reclaim, content):
+                return False
+            try:
+                if not self._expired(lease) or os.path.exists(self._path(subject, 'done')):
+                    return False
+                previous = _read_json(lease)
+                os.remove(lease)
+                if not self._create(lease, {**content, 'previous': previous}):
+                    return False
+                print(f'{subject}: took over the expired lease of {previous["owner"] if previous else "unknown"}')
+            finally:
+                os.remove(reclaim)
+        if os.path.exists(self._path(subject, 'done')):
+            # finished by another instance between the check and the claim
+            os.remove(lease)
+            return False
+        with self._lock:
+            self.held.add(subject)
+        return True
+
+    def release(self, subject, success, message):
+        '''
+        This function records the result of a claimed subject and removes its lease
+
+        :param subject: subject folder name (e.g. "sub-m001")
+        :param success: success flag of the subject
+        :param message: status message of the subject
+        :return: return False if the lease was lost in the meantime (the result is not recorded then)
+        '''
+        with self._lock:
+            self.held.discard(subject)
+            lost = subject in self.lost
+        lease = self._path(subject, 'lease')
+        if lost or (_read_json(lease) or {}).get('owner') != self.owner:
+            return False
+        done = self._path(subject, 'done')
+        tmp = _write_json(done, {'owner': self.owner, 'success': success, 'message': message, 'finished': time.time()})
+        os.replace(tmp, done)
+        os.remove(lease)
+        return True
+
+    def heartbeat(self):
+        '''
+        This function refreshes the leases held by this instance (and notes the ones that were taken over)
+        '''
+        with self._lock:
+            held = list(self.held)
+        for subject in held:
+            lease = self._path(subject, 'lease')
+            if (_read_json(lease) or {}).get('owner') == self.owner:
+                os.utime(lease)
+            else:
+                print(f'{subject}: lease was taken over by another instance')
+                with self._lock:
+                    self.lost.add(subject)
+
+    def __enter__(self):
+        def run():
+            while not self._stop.wait(self.heartbeat_seconds):
+                self.heartbeat()
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        # leases of subjects that were not finished (e.g. on KeyboardInterrupt) are given back
+        with self._lock:
+            held = list(self.held)
+        for subject in held:
+            lease = self._path(subject, 'lease')
+            if (_read_json(lease) or {}).get('owner') == self.owner:
+                os.remove(lease)
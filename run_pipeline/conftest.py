@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+import pytest
+
+from fake_toolchain import create_bids_tree, create_fake_toolchain
+
+# shared fixtures of the end-to-end tests: run_pipeline.py on a small generated BIDS tree with the fake toolchain
+# (see fake_toolchain.py), the behaviour of the fake tools is set with FAKE_* environment variables per run
+
+PIPELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_pipeline.py')
+
+
+@pytest.fixture(scope='session')
+def toolchain(tmp_path_factory):
+    '''
+    :return: return the paths of the fake freesurfer and FSL installations
+    '''
+    return create_fake_toolchain(tmp_path_factory.mktemp('fake'))
+
+
+@pytest.fixture
+def bids(tmp_path):
+    '''
+    :return: return a function creating a BIDS tree with the given number of subjects and returning its path
+    '''
+    def create(number_of_subjects=1):
+        path = str(tmp_path / 'bids')
+        create_bids_tree(path, number_of_subjects)
+        return path
+    return create
+
+
+@pytest.fixture
+def pipeline(toolchain):
+    '''
+    :return: return a function starting run_pipeline.py on a BIDS tree (with additional arguments and FAKE_*
+             variables), it returns the process if wait=False and the completed process otherwise
+    '''
+    def run(bids, *args, env=None, wait=True):
+        freesurfer_path, fsl_path = toolchain
+        command = [sys.executable, PIPELINE, '-i', bids, '-f', freesurfer_path, '-fsl', fsl_path, '-n', '2',
+                   '--cores', '2', '--threads', '1', '--memory_gb', '2', '--memory_per_subject_gb', '0.5'] + list(args)
+        environment = {key: value for key, value in os.environ.items() if not key.startswith('FAKE_')}
+        environment.update(env or {})
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=environment)
+        if not wait:
+            return process
+        output, _ = process.communicate(timeout=600)
+        assert process.returncode == 0, output
+        return output
+    return run
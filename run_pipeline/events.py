@@ -0,0 +1,79 @@
+import os
+import json
+import resource
+import threading
+import time
+from contextlib import contextmanager
+import pandas as pd
+
+# stage timing helpers
+# every stage of a subject appends one event (a json line) to sub-<ID>_events.jsonl in its derivatives folder:
+# start time, worker process, wall time, user/sys CPU time, peak RSS of the external tool (or the increase of the peak RSS
+# of the worker for python stages) and the
+# number of bytes moved by the fan-out stages. summarize_events aggregates the events of a run over the cohort.
+
+_events_lock = threading.Lock()
+
+
+def log_event(filename, event):
+    '''
+    :param filename: path to the .jsonl event log of the subject
+    :param event: dictionary with the event, appended as one json line
+    '''
+    with _events_lock:
+        with open(filename, 'a') as f:
+            f.write(json.dumps(event) + '\n')
+
+
+@contextmanager
+def stage_timer(event):
+    '''
+    This context manager measures the wall time and the CPU time of the calling thread (i.e., the python part of
+    a stage) and adds them to the event dictionary
+
+    :param event: event dictionary, 'wall', 'user', 'sys' and 'maxrss_kb' are set on exit
+    '''
+    start = time.perf_counter()
+    usage_start = resource.getrusage(resource.RUSAGE_THREAD)
+    maxrss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        yield event
+    finally:
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        event['wall'] = time.perf_counter() - start
+        event['user'] = usage.ru_utime - usage_start.ru_utime
+        event['sys'] = usage.ru_stime - usage_start.ru_stime
+        # increase of the peak RSS of the worker process during the stage (ru_maxrss is not available per thread,
+        # and the peak over the lifetime of the worker would include the previous subjects)
+        event['maxrss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - maxrss_start
+
+
+def summarize_events(filenames, run_id=None):
+    '''
+    This function aggregates the stage events of the cohort into a summary table (one row per stage type,
+    e.g. all 'coreg_<i>' stages are combined into 'coreg')
+
+    :param filenames: list of .jsonl event logs
+    :param run_id: only use the events of this run (default: all events)
+    :return: return the summary table as dataframe
+    '''
+    events = []
+    for filename in filenames:
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                events += [json.loads(line) for line in f if line.strip()]
+    df = pd.DataFrame(events, columns=['run', 'subject', 'stage', 'status', 'wall', 'user', 'sys', 'maxrss_kb', 'bytes'])
+    if run_id is not None:
+        df = df[df['run'] == run_id]
+    df = df[df['status'] != 'skipped'].copy()
+    df['stage'] = df['stage'].str.replace(r'_\d+$', '', regex=True)
+    df['cpu'] = df['user'] + df['sys']
+    summary = df.groupby('stage', sort=False).agg(n=('subject', 'size'),
+                                                  failed=('status', lambda x: int(sum(x == 'failed'))),
+                                                  wall_mean_s=('wall', 'mean'),
+                                                  wall_max_s=('wall', 'max'),
+                                                  wall_total_h=('wall', lambda x: x.sum() / 3600),
+                                                  cpu_total_h=('cpu', lambda x: x.sum() / 3600),
+                                                  maxrss_mb=('maxrss_kb', lambda x: x.max() / 1024),
+                                                  moved_gb=('bytes', lambda x: x.sum() / 1024 ** 3))
+    return summary.reset_index()
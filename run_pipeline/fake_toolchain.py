@@ -0,0 +1,168 @@
+import argparse
+import os
+import re
+import shutil
+import stat
+import sys
+import time
+import nibabel as nib
+import numpy as np
+
+# Fake FreeSurfer/FSL toolchain to exercise run_pipeline.py without the real tools.
+# The fake executables write correctly named (tiny) outputs, the segmentations contain synthetic lesions (label 99).
+# Their behaviour is controlled with environment variables (<TOOL> e.g. MRI_COREG or RUN_SAMSEG_LONG):
+#   FAKE_DELAY=<seconds>        runtime of every tool (default: 0)
+#   FAKE_<TOOL>_DELAY=<seconds> runtime of a single tool
+#   FAKE_<TOOL>_EXIT=<code>     let a tool fail with the given exit code
+#   FAKE_<TOOL>_HANG=1          let a tool hang (to test timeouts)
+#   FAKE_<TOOL>_HANG_TIMES=<n>  let the first n calls of a tool in a working directory hang (to test retries)
+#
+# usage: python fake_toolchain.py --output_directory /tmp/fake
+#        python run_pipeline.py -i /path/to/bids -f /tmp/fake/freesurfer -fsl /tmp/fake/fsl
+
+FREESURFER_TOOLS = ['mri_robust_template', 'mri_coreg', 'mri_vol2vol', 'run_samseg_long']
+FSL_TOOLS = ['siena']
+
+
+def create_fake_toolchain(path):
+    '''
+    This function creates a fake FreeSurfer and FSL installation with executables that call this script
+
+    :param path: destination folder
+    :return: return the paths of the fake freesurfer and FSL installations
+    '''
+    freesurfer_path = os.path.join(os.path.abspath(path), 'freesurfer')
+    fsl_path = os.path.join(os.path.abspath(path), 'fsl')
+    for home, tools in [(freesurfer_path, FREESURFER_TOOLS), (fsl_path, FSL_TOOLS)]:
+        os.makedirs(os.path.join(home, 'bin'), exist_ok=True)
+        for tool in tools:
+            executable = os.path.join(home, 'bin', tool)
+            with open(executable, 'w') as f:
+                f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" {tool} "$@"\n')
+            os.chmod(executable, os.stat(executable).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    with open(os.path.join(freesurfer_path, 'build-stamp.txt'), 'w') as f:
+        f.write('fake-freesurfer-7.3.2\n')
+    os.makedirs(os.path.join(fsl_path, 'etc', 'fslconf'), exist_ok=True)
+    with open(os.path.join(fsl_path, 'etc', 'fslconf', 'fsl.sh'), 'w') as f:
+        f.write('FSLOUTPUTTYPE=NIFTI_GZ\nexport FSLOUTPUTTYPE\n')
+    with open(os.path.join(fsl_path, 'etc', 'fslversion'), 'w') as f:
+        f.write('fake-fsl-6.0\n')
+    return freesurfer_path, fsl_path
+
+
+def create_bids_tree(path, number_of_subjects, number_of_sessions=2):
+    '''
+    This function creates a BIDS tree with small T1w and FLAIR images (the same image copied for every session)
+
+    :param path: destination folder (removed first if it exists)
+    :param number_of_subjects: number of subjects (sub-b0001, ...)
+    :param number_of_sessions: number of sessions per subject
+    '''
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    image = os.path.join(path, 'image.nii.gz')
+    data = np.random.default_rng(0).integers(0, 1000, (32, 32, 32), dtype=np.int16)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), image)
+    for i in range(1, number_of_subjects + 1):
+        for k in range(number_of_sessions):
+            session = f'ses-{2010 + k}0101'
+            folder = os.path.join(path, f'sub-b{i:04d}', session, 'anat')
+            os.makedirs(folder)
+            for modality in ['T1w', 'FLAIR']:
+                shutil.copyfile(image, os.path.join(folder, f'sub-b{i:04d}_{session}_{modality}.nii.gz'))
+    os.remove(image)
+
+
+def option(args, flag, n=1):
+    i = args.index(flag)
+    return args[i + 1:i + 1 + n]
+
+
+def option_list(args, flag):
+    values = []
+    for x in args[args.index(flag) + 1:]:
+        if x.startswith('--'):
+            break
+        values.append(x)
+    return values
+
+
+def synthetic_segmentation(timepoint, shape=(64, 64, 64)):
+    '''
+    :param timepoint: index of the timepoint, lesions are added and grow over time
+    :return: return a label volume with white matter (2) and lesions (99)
+    '''
+    seg = np.full(shape, 2, dtype=np.int32)
+    rng = np.random.default_rng(0)
+    zz, yy, xx = np.indices(shape)
+    for k in range(12 + 4 * timepoint):
+        center = rng.integers(8, np.array(shape) - 8)
+        radius = rng.uniform(1.5, 4.0) + (0.5 * timepoint if k % 3 == 0 else 0)
+        seg[(zz - center[0]) ** 2 + (yy - center[1]) ** 2 + (xx - center[2]) ** 2 <= radius ** 2] = 99
+    return seg
+
+
+def write_file(path, content='fake\n'):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def fake_tool(tool, args):
+    key = re.sub(r'\W', '_', tool).upper()
+    time.sleep(float(os.environ.get(f'FAKE_{key}_DELAY', os.environ.get('FAKE_DELAY', 0))))
+    hang = bool(os.environ.get(f'FAKE_{key}_HANG'))
+    if os.environ.get(f'FAKE_{key}_HANG_TIMES'):
+        # the calls are counted in the working directory (the temp folder of the subject)
+        counter = f'.fake_{tool}_calls'
+        calls = int(open(counter).read()) if os.path.exists(counter) else 0
+        write_file(counter, str(calls + 1))
+        hang = calls < int(os.environ[f'FAKE_{key}_HANG_TIMES'])
+    if hang:
+        while True:
+            time.sleep(60)
+    if os.environ.get(f'FAKE_{key}_EXIT'):
+        print(f'{tool}: fake failure', file=sys.stderr)
+        return int(os.environ[f'FAKE_{key}_EXIT'])
+
+    print(f'{tool} {" ".join(args)}')
+    if tool == 'mri_robust_template':
+        write_file(option(args, '--template')[0])
+        for x in option_list(args, '--mapmov'):
+            write_file(x)
+    elif tool == 'mri_coreg':
+        write_file(option(args, '--reg')[0])
+    elif tool == 'mri_vol2vol':
+        write_file(option(args, '--o')[0])
+    elif tool == 'run_samseg_long':
+        output = option(args, '-o')[0]
+        os.makedirs(os.path.join(output, 'base'), exist_ok=True)
+        write_file(os.path.join(output, 'base', 'samseg.stats'))
+        for i in range(args.count('--timepoint')):
+            tp_folder = os.path.join(output, f'tp{i + 1:03d}')
+            os.makedirs(tp_folder, exist_ok=True)
+            seg = synthetic_segmentation(i)
+            nib.save(nib.MGHImage(seg, np.eye(4)), os.path.join(tp_folder, 'seg.mgz'))
+            write_file(os.path.join(tp_folder, 'samseg.stats'),
+                       f'# Measure Left-Lateral-Ventricle, {5000.0 + 100 * i:.6f}, mm^3\n'
+                       f'# Measure Lesions, {float(np.sum(seg == 99)):.6f}, mm^3\n')
+            write_file(os.path.join(tp_folder, 'sbtiv.stats'), '# Measure Intra-Cranial, 1500000.000000, mm^3\n')
+    elif tool == 'siena':
+        output = option(args, '-o')[0]
+        write_file(os.path.join(output, 'report.siena'), 'finalPBVC -0.512\n')
+        write_file(os.path.join(output, 'report.html'),
+                   '<html><body>' + ''.join(f'<b>step {k}</b>' for k in range(5)) + '<b>PBVC: -0.512 </b></body></html>\n')
+    return 0
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1 and sys.argv[1] in FREESURFER_TOOLS + FSL_TOOLS:
+        sys.exit(fake_tool(sys.argv[1], sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(description='Create a fake FreeSurfer/FSL toolchain for testing run_pipeline.py.')
+    parser.add_argument('-o', '--output_directory', help='Destination folder of the fake toolchain.', required=True)
+    args = parser.parse_args()
+
+    freesurfer_path, fsl_path = create_fake_toolchain(args.output_directory)
+    print(f'--freesurfer_path {freesurfer_path} --fsl_path {fsl_path}')
@@ -0,0 +1,151 @@
+import json
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+# BIDS layout index
+# the files of a BIDS folder (raw data or derivatives) are listed once with os.scandir and indexed by
+# subject -> session -> suffix (e.g. 'T1w', 'FLAIR', 'seg', 'samseg', 'sbtiv'), files directly in the subject folder
+# are indexed under the session ''. Only the subject folder, its ses-* folders and their subfolders are scanned
+# (not e.g. the temp or logs folders of the derivatives).
+# The index can be cached in a json file together with the mtime of every scanned folder; a subject is only scanned
+# again if one of its folders changed (i.e. files were added, removed or renamed).
+
+NIFTI = ('.nii', '.nii.gz')
+
+
+def split_filename(name):
+    '''
+    :param name: BIDS file name, e.g. "sub-m001_ses-20100101_T1w.nii.gz"
+    :return: return the suffix and the extension, e.g. ('T1w', '.nii.gz')
+    '''
+    stem = name.split('.', 1)[0]
+    return stem.rsplit('_', 1)[-1], name[len(stem):]
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def scan_subject(root, name):
+    '''
+    :param root: BIDS folder
+    :param name: name of the subject folder (e.g. "sub-m001")
+    :return: return the index entry of the subject: the mtimes of the scanned folders and the files (relative to
+             root) per session and suffix
+    '''
+    mtimes = {}
+    sessions = {}
+
+    def scan(folder, session, recursive):
+        mtimes[folder] = _mtime(os.path.join(root, folder))
+        with os.scandir(os.path.join(root, folder)) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if recursive or (folder == name and entry.name.startswith('ses-')):
+                        scan(os.path.join(folder, entry.name), session or entry.name[4:], True)
+                elif not entry.name.startswith('.'):
+                    suffix, _ = split_filename(entry.name)
+                    sessions.setdefault(session, {}).setdefault(suffix, []).append(os.path.join(folder, entry.name))
+
+    scan(name, '', False)
+    for files in sessions.values():
+        for suffix in files:
+            files[suffix].sort()
+    return {'mtimes': mtimes, 'sessions': sessions}
+
+
+class BidsLayout:
+    '''
+    Index of the subjects, sessions and files of a BIDS folder, built once and cached (see above)
+    '''
+
+    def __init__(self, root, cache_file=None, subjects=None, max_workers=16):
+        '''
+        :param root: BIDS folder
+        :param cache_file: json file the index is cached in (optional)
+        :param subjects: only index these subject folders (names, e.g. ["sub-m001"]; default: all sub-* folders)
+        :param max_workers: number of folders checked/scanned concurrently
+        '''
+        self.root = root
+        cache = {}
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+            if cache.get('root') != os.path.abspath(root):
+                cache = {}
+        cached = cache.get('subjects', {})
+
+        partial = subjects is not None
+        if not partial:
+            # the list of subjects only has to be read again if the root folder changed
+            root_mtime = _mtime(root)
+            if cache and cache.get('mtime') == root_mtime:
+                subjects = sorted(cached)
+            else:
+                with os.scandir(root) as entries:
+                    subjects = sorted(x.name for x in entries if x.name.startswith('sub-') and x.is_dir())
+        else:
+            root_mtime = cache.get('mtime')
+
+        def refresh(name):
+            entry = cached.get(name)
+            if entry is not None and all(_mtime(os.path.join(root, x)) == m for x, m in entry['mtimes'].items()):
+                return entry, False
+            return scan_subject(root, name), True
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            refreshed = list(executor.map(refresh, subjects))
+        # subjects are indexed by their ID (e.g. "m001" for "sub-m001")
+        self.index = {name[4:]: entry for name, (entry, _) in zip(subjects, refreshed)}
+        self.scanned = sum(x for _, x in refreshed)
+
+        changed = self.scanned or (not partial and (root_mtime != cache.get('mtime') or set(subjects) != set(cached)))
+        if cache_file is not None and changed:
+            # if only some subjects were indexed, the cached entries of the others are kept
+            entries = dict(cached) if partial else {}
+            entries.update({'sub-' + x: entry for x, entry in self.index.items()})
+            # (unique temporary file, several pipeline instances may update the cache at the same time)
+            tmp = f'{cache_file}.{socket.gethostname()}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'root': os.path.abspath(root), 'mtime': root_mtime, 'subjects': entries}, f)
+            os.replace(tmp, cache_file)
+
+    def subjects(self):
+        '''
+        :return: return the sorted subject IDs
+        '''
+        return sorted(self.index)
+
+    def subject_dir(self, subject):
+        '''
+        :param subject: subject ID
+        :return: return the path of the subject folder
+        '''
+        return os.path.join(self.root, 'sub-' + subject)
+
+    def sessions(self, subject):
+        '''
+        :param subject: subject ID
+        :return: return the sorted session IDs of the subject
+        '''
+        return sorted(x for x in self.index[subject]['sessions'] if x)
+
+    def files(self, subject, suffix, session=None, extensions=None):
+        '''
+        :param subject: subject ID
+        :param suffix: BIDS suffix of the files (e.g. 'T1w')
+        :param session: session ID ('' for the files in the subject folder, default: the subject folder and all
+                        sessions in sorted order)
+        :param extensions: only return files with these extensions (e.g. NIFTI)
+        :return: return the list of paths
+        '''
+        sessions = self.index[subject]['sessions']
+        names = sorted(sessions) if session is None else [session]
+        files = [x for ses in names for x in sessions.get(ses, {}).get(suffix, [])]
+        if extensions is not None:
+            files = [x for x in files if split_filename(os.path.basename(x))[1] in extensions]
+        return [os.path.join(self.root, x) for x in files]
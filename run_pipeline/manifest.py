@@ -0,0 +1,175 @@
+import os
+import json
+import threading
+from datetime import datetime
+
+# stage manifest helpers
+# every subject keeps a manifest (sub-<ID>_manifest.json in its derivatives folder) with one record per completed
+# stage: the signature (size, mtime) of its input files, the files it produced and the version of the tool used.
+# On a rerun, a stage is skipped if its record is still valid, i.e. its inputs and tool did not change and its
+# outputs are still available (in the temp folder, or at the location they were moved to by the fan-out).
+
+_manifest_lock = threading.Lock()
+
+
+def file_signature(path):
+    '''
+    :param path: path to a file or folder
+    :return: return the [size, mtime (ns)] of the file, or None if it does not exist
+    '''
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def tool_version(path):
+    '''
+    This function reads the version of an external tool from a version/build-stamp file
+    (e.g. $FREESURFER_HOME/build-stamp.txt or $FSLDIR/etc/fslversion)
+
+    :param path: path to the version file
+    :return: return the version string or 'unknown' if the file can not be read
+    '''
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return 'unknown'
+
+
+def load_manifest(filename):
+    '''
+    :param filename: path to the manifest .json file
+    :return: return the manifest as dictionary (empty manifest if the file does not exist)
+    '''
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            return json.load(f)
+    return {'stages': {}, 'moved': {}}
+
+
+def save_manifest(filename, manifest):
+    '''
+    This function writes the manifest to a temporary file and renames it, so a crash never leaves a truncated manifest
+
+    :param filename: path to the manifest .json file
+    :param manifest: manifest dictionary
+    '''
+    with _manifest_lock:
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(filename + '.tmp', filename)
+
+
+def resolve_path(manifest, path):
+    '''
+    :param manifest: manifest dictionary
+    :param path: path of a file as it was produced by a stage
+    :return: return the current location of the file (follows the moves done by the fan-out stages)
+    '''
+    if not os.path.exists(path) and path in manifest['moved']:
+        return manifest['moved'][path]
+    return path
+
+
+def relocate(manifest, temp_dir, previous_temp_dir):
+    '''
+    This function moves the records of the manifest to another temp folder (e.g. when the pipeline is rerun with or
+    without a scratch folder): the recorded paths in the old temp folder are replaced by the same paths in the new
+    one. Files that were moved by the fan-out are still found at their targets, intermediate files that were not moved
+    are missing in the new temp folder, so the stages producing them are rerun.
+
+    :param manifest: manifest dictionary (modified in place)
+    :param temp_dir: current temp folder
+    :param previous_temp_dir: temp folder of manifests that do not record it (older runs)
+    '''
+    old = manifest.get('temp_dir', previous_temp_dir)
+    manifest['temp_dir'] = temp_dir
+    if old == temp_dir:
+        return
+
+    def move(path):
+        if path == old or path.startswith(old + os.sep):
+            return temp_dir + path[len(old):]
+        return path
+
+    for record in manifest['stages'].values():
+        record['inputs'] = {move(x): signature for x, signature in record['inputs'].items()}
+        record['outputs'] = [move(x) for x in record['outputs']]
+    manifest['moved'] = {move(x): target for x, target in manifest['moved'].items()}
+
+
+def record_stage(filename, manifest, name, inputs, outputs, version, moved=None):
+    '''
+    This function adds the record of a completed stage to the manifest and saves it
+
+    :param filename: path to the manifest .json file
+    :param manifest: manifest dictionary
+    :param name: name of the stage
+    :param inputs: dictionary of input paths to their signature taken before the stage was run
+    :param outputs: list of paths produced by the stage
+    :param version: version of the tool used by the stage
+    :param moved: dictionary of original path to target path of files moved by the stage
+    '''
+    with _manifest_lock:
+        manifest['stages'][name] = {'inputs': inputs,
+                                    'outputs': list(outputs),
+                                    'version': version,
+                                    'finished': datetime.now().isoformat(timespec='seconds')}
+        if moved:
+            manifest['moved'].update(moved)
+    save_manifest(filename, manifest)
+
+
+def stage_is_valid(manifest, name, version):
+    '''
+    :param manifest: manifest dictionary
+    :param name: name of the stage
+    :param version: current version of the tool used by the stage
+    :return: return True if the stage was completed with the same tool version, its inputs did not change and
+             all its outputs are still available
+    '''
+    record = manifest['stages'].get(name)
+    if record is None or record['version'] != version:
+        return False
+    for path, signature in record['inputs'].items():
+        if file_signature(resolve_path(manifest, path)) != signature:
+            return False
+    return all(os.path.exists(resolve_path(manifest, path)) for path in record['outputs'])
+
+
+def plan_stages(manifest, dependencies, versions, force_stages=()):
+    '''
+    This function decides which stages of a subject have to be (re)run
+
+    :param manifest: manifest dictionary
+    :param dependencies: dictionary mapping each stage name to the list of stages it depends on (in topological order)
+    :param versions: dictionary mapping each stage name to the current version of its tool
+    :param force_stages: stage names (or prefixes, e.g. 'coreg' for all 'coreg_<i>' stages) to rerun in any case
+    :return: return the set of stages to run
+    '''
+    def forced(name):
+        return any(name == f or name.startswith(f + '_') for f in force_stages) or 'all' in force_stages
+
+    def propagate(rerun):
+        # a stage has to be rerun if one of its dependencies is rerun
+        for name, deps in dependencies.items():
+            if any(d in rerun for d in deps):
+                rerun.add(name)
+
+    rerun = {name for name in dependencies if forced(name) or not stage_is_valid(manifest, name, versions[name])}
+    propagate(rerun)
+    # a stage that is rerun needs the outputs of its dependencies at their original location,
+    # if they were already moved by the fan-out, the dependency has to be rerun as well
+    changed = True
+    while changed:
+        changed = False
+        for name in list(rerun):
+            for d in dependencies[name]:
+                if d not in rerun and not all(os.path.exists(p) for p in manifest['stages'][d]['outputs']):
+                    rerun.add(d)
+                    changed = True
+        propagate(rerun)
+    return rerun
@@ -0,0 +1,143 @@
+import gzip
+import os
+import socket
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from layout import NIFTI
+
+# preflight validation of the BIDS folder
+# before any subject is scheduled, the T1w/FLAIR images of all subjects are checked by reading only their headers
+# (nibabel loads images lazily): pairing of T1w and FLAIR per session, number of timepoints, dimensions, voxel sizes,
+# orientation and integrity of the gzip file. For the gzip check, the size stored in the gzip trailer is compared with
+# the size given by the header; only if they differ (or with full=True) the whole file is decompressed.
+# Subjects with problems are reported and not scheduled.
+
+MIN_SHAPE = 16
+MAX_VOXEL_SIZE = 10.0
+
+
+def check_gzip(path, expected_size, full=False):
+    '''
+    :param path: path to a .gz file
+    :param expected_size: uncompressed size in bytes according to the nifti header
+    :param full: always decompress the whole file (checks the crc32)
+    :return: return a problem description, or None if the file is ok
+    '''
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() < 18:
+            return 'truncated gzip file'
+        f.seek(-4, os.SEEK_END)
+        trailer_size = struct.unpack('<L', f.read(4))[0]
+    if trailer_size == expected_size & 0xffffffff and not full:
+        return None
+    # the trailer does not match (truncated or multi-member gzip file), decompress it to find out
+    size = 0
+    try:
+        with gzip.open(path, 'rb') as f:
+            while True:
+                data = f.read(16 * 1024 ** 2)
+                if not data:
+                    break
+                size += len(data)
+    except (OSError, EOFError, zlib.error) as e:
+        return f'corrupt gzip file ({type(e).__name__}: {e})'
+    if size < expected_size:
+        return f'image data truncated ({size} of {expected_size} bytes)'
+    return None
+
+
+def check_image(path, full=False):
+    '''
+    :param path: path to a nifti image
+    :param full: decompress the whole image to check the gzip integrity
+    :return: return a dictionary with the header information and the problems found
+    '''
+    info = {'file': os.path.basename(path), 'shape': '', 'voxel_size': '', 'orientation': '', 'problem': ''}
+    problems = []
+    try:
+        img = nib.load(path)
+        shape = img.shape
+        zooms = img.header.get_zooms()[:3]
+        info['shape'] = 'x'.join(map(str, shape))
+        info['voxel_size'] = 'x'.join(f'{x:.2f}' for x in zooms)
+        if len(shape) < 3 or len(shape) > 4 or (len(shape) == 4 and shape[3] != 1):
+            problems.append(f'not a 3D image (shape {shape})')
+        elif min(shape[:3]) < MIN_SHAPE:
+            problems.append(f'too small (shape {shape})')
+        if not all(np.isfinite(zooms)) or min(zooms) <= 0 or max(zooms) > MAX_VOXEL_SIZE:
+            problems.append(f'invalid voxel size {zooms}')
+        if not np.all(np.isfinite(img.affine)) or abs(np.linalg.det(img.affine[:3, :3])) < 1e-6:
+            problems.append('degenerate affine')
+        else:
+            info['orientation'] = ''.join(nib.aff2axcodes(img.affine))
+        expected_size = int(img.header['vox_offset']) + int(np.prod(shape)) * img.get_data_dtype().itemsize
+        if path.endswith('.gz'):
+            problem = check_gzip(path, expected_size, full)
+        elif os.path.getsize(path) < expected_size:
+            problem = f'image data truncated ({os.path.getsize(path)} of {expected_size} bytes)'
+        else:
+            problem = None
+        if problem is not None:
+            problems.append(problem)
+    except Exception as e:
+        problems.append(f'unreadable header ({type(e).__name__}: {e})')
+    info['problem'] = '; '.join(problems)
+    return info
+
+
+def check_subject(layout, subject, full=False):
+    '''
+    :param layout: BidsLayout of the BIDS folder
+    :param subject: subject ID
+    :param full: decompress the whole images to check the gzip integrity
+    :return: return the report rows of the subject (one per image, plus one per problem of the subject)
+    '''
+    rows = []
+    timepoints = 0
+    for session in layout.sessions(subject):
+        t1w = layout.files(subject, 'T1w', session, extensions=NIFTI)
+        flair = layout.files(subject, 'FLAIR', session, extensions=NIFTI)
+        if not t1w and not flair:
+            continue
+        if len(t1w) != 1 or len(flair) != 1:
+            rows.append({'session': session, 'file': '', 'problem': f'{len(t1w)} T1w and {len(flair)} FLAIR images'})
+        else:
+            timepoints += 1
+        for x in t1w + flair:
+            rows.append({'session': session, **check_image(x, full)})
+    if timepoints < 2:
+        rows.append({'session': '', 'file': '', 'problem': f'{timepoints} complete timepoint(s), at least 2 are needed'})
+    return [{'subject': f'sub-{subject}', **x} for x in rows]
+
+
+def preflight(layout, report_path, full=False, max_workers=16):
+    '''
+    This function checks all subjects of the BIDS folder in parallel and writes the report
+
+    :param layout: BidsLayout of the BIDS folder
+    :param report_path: path to the report .csv file
+    :param full: decompress the whole images to check the gzip integrity
+    :param max_workers: number of subjects checked at the same time
+    :return: return the list of runnable subject IDs and a dictionary of subject ID to problems for the others
+    '''
+    subjects = layout.subjects()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        rows = list(executor.map(lambda x: check_subject(layout, x, full), subjects))
+    report = pd.DataFrame([x for r in rows for x in r],
+                          columns=['subject', 'session', 'file', 'shape', 'voxel_size', 'orientation', 'problem'])
+    tmp = f'{report_path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    report.to_csv(tmp, index=False)
+    os.replace(tmp, report_path)
+    failed = {}
+    for subject, subject_rows in zip(subjects, rows):
+        problems = [(f'ses-{x["session"]} ' if x['session'] else '') + (f'{x["file"]}: ' if x['file'] else '') + x['problem']
+                    for x in subject_rows if x['problem']]
+        if problems:
+            failed[subject] = '; '.join(problems)
+    return [x for x in subjects if x not in failed], failed
@@ -0,0 +1,154 @@
+import argparse
+import contextlib
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+
+from layout import BidsLayout
+from samseg_stats import generate_samseg_stats
+
+# batch re-scoring of the longitudinal lesion stats
+# generate_samseg_stats is run again on the baseline/follow-up _seg.mgz files of all subjects in an existing
+# derivatives folder (first and second session, as in run_pipeline.py) with the given min_size, connectivity and
+# max_overlap, in a process pool and without FreeSurfer/FSL. The results of every parameter set are written to their
+# own folder (e.g. rescore/minsize-15.0_conn-18_maxoverlap-0.3) with one sub-*_longi_lesions.csv per subject and a
+# cohort summary (lesion_stats.csv). Subjects whose results (with --save_images including the label maps) are newer
+# than their segmentations are not computed again.
+
+# label maps written by generate_samseg_stats with save_images (sub-<ID>_<name>_lesions.nii.gz)
+LABEL_MAPS = ['bl', 'fu', 'fu-min-bl', 'bl-min-fu']
+
+
+def parameter_tag(min_size, connectivity, max_overlap):
+    '''
+    :return: return the name of the output folder of a parameter set, e.g. "minsize-15.0_conn-18_maxoverlap-0.3"
+    '''
+    return f'minsize-{float(min_size)}_conn-{int(connectivity)}_maxoverlap-{float(max_overlap)}'
+
+
+def find_subjects(layout):
+    '''
+    :param layout: BidsLayout of the derivatives folder
+    :return: return a list of (subject ID, baseline _seg.mgz, follow-up _seg.mgz) of the subjects with at least two
+             segmented sessions
+    '''
+    subjects = []
+    for subID in layout.subjects():
+        seg = [x for sesID in layout.sessions(subID) for x in layout.files(subID, 'seg', sesID, extensions=('.mgz',))]
+        if len(seg) > 1:
+            subjects.append((subID, seg[0], seg[1]))
+    return subjects
+
+
+def rescore_subject(subID, bl_path, fu_path, output_path, min_size, connectivity, max_overlap, save_images=False,
+                    pbvc=None, overwrite=False, compress_level=6):
+    '''
+    This function computes the lesion stats of one subject (unless they are up to date) and reads them back
+
+    :param subID: the subject ID
+    :param bl_path: path to the baseline segmentation
+    :param fu_path: path to the follow-up segmentation
+    :param output_path: output folder of the parameter set
+    :param min_size: minimum lesion volume in mm^3
+    :param connectivity: connected component connectivity (6, 18 or 26)
+    :param max_overlap: maximum overlap of a dilated new/disappearing lesion with the other timepoint
+    :param save_images: also write the lesion label maps
+    :param pbvc: PBVC of the subject, copied to the lesion csv (optional)
+    :param overwrite: compute the stats even if they are up to date
+    :param compress_level: gzip compression level of the label maps (1: fastest, 9: smallest)
+    :return: return the lesion stats as dictionary and a flag whether they were computed
+    '''
+    csv_path = os.path.join(output_path, f'sub-{subID}_longi_lesions.csv')
+    results = [csv_path]
+    if save_images:
+        # the label maps are only written with save_images, results of a run without them are not up to date
+        results += [os.path.join(output_path, f'sub-{subID}_{x}_lesions.nii.gz') for x in LABEL_MAPS]
+    inputs_mtime = max(os.path.getmtime(bl_path), os.path.getmtime(fu_path))
+    computed = overwrite or not all(os.path.exists(x) and os.path.getmtime(x) >= inputs_mtime for x in results)
+    if computed:
+        # the per-lesion messages of generate_samseg_stats are not printed for every subject of the cohort
+        with contextlib.redirect_stdout(io.StringIO()):
+            generate_samseg_stats(bl_path=bl_path, fu_path=fu_path, output_path=output_path, min_size=min_size,
+                                  connectivity=connectivity, max_overlap=max_overlap, save_images=save_images, pbvc=pbvc,
+                                  compress_level=compress_level)
+    record = pd.read_csv(csv_path, dtype={'sub-ID': str}).iloc[0].to_dict()
+    return record, computed
+
+
+def read_pbvc(derivatives_dir, subID):
+    '''
+    :return: return the PBVC recorded by the pipeline in the lesion csv of the subject (None if there is none)
+    '''
+    csv_path = os.path.join(derivatives_dir, f'sub-{subID}', f'sub-{subID}_longi_lesions.csv')
+    if os.path.exists(csv_path):
+        df = pd.read_csv(csv_path)
+        if 'pbvc' in df.columns:
+            return float(df['pbvc'].iloc[0])
+    return None
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Recompute the longitudinal lesion stats of a processed cohort with other parameters.')
+    parser.add_argument('-i', '--input_directory', help='Folder of BIDS database (processed by run_pipeline.py).', required=True)
+    parser.add_argument('-o', '--output_directory', help='Destination folder (default: derivatives/samseg-longitudinal-7.3.2/rescore).')
+    parser.add_argument('-n', '--number_of_workers', help='Number of subjects processed in parallel.', type=int, default=os.cpu_count())
+    parser.add_argument('--min_size', help='Minimum lesion volume in mm^3.', type=float, default=15.0)
+    parser.add_argument('--connectivity', help='Connected component connectivity.', type=int, default=18, choices=[6, 18, 26])
+    parser.add_argument('--max_overlap', help='Maximum overlap between a dilated lesion and another lesion to classify it as '
+                                              'new/disappearing (fraction of its volume).', type=float, default=0.3)
+    parser.add_argument('--save_images', action='store_true', help='Also write the lesion label maps of every subject.')
+    parser.add_argument('--compress_level', help='gzip compression level of the label maps (1: fastest, 9: smallest).',
+                        type=int, default=6, choices=range(1, 10))
+    parser.add_argument('--overwrite', action='store_true', help='Recompute the stats of all subjects, even if they are up to date.')
+
+    args = parser.parse_args()
+
+    derivatives_dir = os.path.join(args.input_directory, "derivatives/samseg-longitudinal-7.3.2")
+    output_directory = args.output_directory or os.path.join(derivatives_dir, 'rescore')
+    output_path = os.path.join(output_directory, parameter_tag(args.min_size, args.connectivity, args.max_overlap))
+    os.makedirs(output_path, exist_ok=True)
+
+    # find the segmentations with the layout index of the derivatives (cached in the output folder, see layout.py)
+    layout = BidsLayout(derivatives_dir, cache_file=os.path.join(output_directory, 'layout_index.json'))
+    subjects = find_subjects(layout)
+    print(f'{len(subjects)} subjects with baseline and follow-up segmentation, output: {output_path}')
+
+    start = time.perf_counter()
+    records = []
+    errors = []
+    computed = 0
+    with ProcessPoolExecutor(max_workers=args.number_of_workers) as executor:
+        futures = {executor.submit(rescore_subject, subID, bl_path, fu_path, output_path, args.min_size, args.connectivity,
+                                   args.max_overlap, args.save_images, read_pbvc(derivatives_dir, subID), args.overwrite,
+                                   args.compress_level): subID
+                   for subID, bl_path, fu_path in subjects}
+        for future in as_completed(futures):
+            subID = futures[future]
+            try:
+                record, was_computed = future.result()
+            except Exception as e:
+                errors.append([subID, f'{type(e).__name__}: {e}'])
+                print(f'[{len(records) + len(errors)}/{len(subjects)}] FAILED: sub-{subID} ({errors[-1][1]})')
+                continue
+            records.append(record)
+            computed += was_computed
+
+    # cohort summary (one row per subject, with the parameters)
+    errors_file = os.path.join(output_path, 'rescore_errors.csv')
+    if errors:
+        pd.DataFrame(errors, columns=['sub-ID', 'error']).sort_values('sub-ID').to_csv(errors_file, index=False)
+    elif os.path.exists(errors_file):
+        os.remove(errors_file)
+    if not records:
+        raise SystemExit('no subject could be scored, no summary written')
+    summary = pd.DataFrame.from_records(records).sort_values('sub-ID').reset_index(drop=True)
+    summary.insert(1, 'min_size', args.min_size)
+    summary.insert(2, 'connectivity', args.connectivity)
+    summary.insert(3, 'max_overlap', args.max_overlap)
+    summary.to_csv(os.path.join(output_path, 'lesion_stats.csv'), index=False)
+
+    print(f'{computed} subjects computed, {len(records) - computed} up to date, {len(errors)} failed '
+          f'in {time.perf_counter() - start:.1f} s' + (f' (see {errors_file})' if errors else ''))
@@ -0,0 +1,76 @@
+import json
+import sqlite3
+from manifest import file_signature
+
+# results store of run_analysis.py
+# the parsed records (volumes of a session, lesion data of a subject) are kept in an sqlite database in the output
+# folder, keyed by (kind, subject, session), together with the signature (size, mtime) of the files they were parsed
+# from. On a rerun, only the records whose files are new or changed are parsed again.
+
+
+class ResultsStore:
+    '''
+    Persistent store of the records parsed by run_analysis.py (one row per kind, subject and session)
+    '''
+
+    def __init__(self, filename):
+        '''
+        :param filename: path to the sqlite database (created if it does not exist)
+        '''
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS records (kind TEXT, sub_id TEXT, ses_id TEXT, '
+                                'sources TEXT, record TEXT, PRIMARY KEY (kind, sub_id, ses_id))')
+        # all stored rows are loaded once, lookups are done in memory
+        self._rows = {(kind, sub_id, ses_id): (sources, record) for kind, sub_id, ses_id, sources, record
+                      in self.connection.execute('SELECT kind, sub_id, ses_id, sources, record FROM records')}
+
+    @staticmethod
+    def signatures(filenames):
+        '''
+        :param filenames: list of source files of a record
+        :return: return a dictionary mapping the files to their [size, mtime (ns)] (None if they do not exist)
+        '''
+        return {x: file_signature(x) for x in filenames}
+
+    def lookup(self, key, signatures):
+        '''
+        :param key: tuple (kind, subject ID, session ID)
+        :param signatures: current signatures of the source files of the record (see signatures)
+        :return: return the stored record if its source files did not change, otherwise None
+        '''
+        row = self._rows.get(key)
+        if row is None or json.loads(row[0]) != signatures:
+            return None
+        return json.loads(row[1])
+
+    def put(self, key, signatures, record):
+        '''
+        This function adds or replaces a record (written to the database on commit)
+
+        :param key: tuple (kind, subject ID, session ID)
+        :param signatures: signatures of the source files, taken before the files were parsed
+        :param record: the parsed record (json-serializable)
+        '''
+        row = (json.dumps(signatures), json.dumps(record))
+        self._rows[key] = row
+        self.connection.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)', (*key, *row))
+
+    def prune(self, keys):
+        '''
+        This function deletes the records that are not in keys (e.g. of subjects removed from the derivatives)
+
+        :param keys: keys of the records to keep
+        :return: return the number of deleted records
+        '''
+        removed = set(self._rows) - set(keys)
+        self.connection.executemany('DELETE FROM records WHERE kind = ? AND sub_id = ? AND ses_id = ?', removed)
+        for key in removed:
+            del self._rows[key]
+        return len(removed)
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
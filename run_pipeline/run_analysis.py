@@ -5,40 +5,52 @@ import pandas as pd
 import re
 import numpy as np
 
-from utils import getSegList, getSessionID, getSubjectID, parse_pbvc_from_html_fsl
+from layout import BidsLayout
+from results_store import ResultsStore
+from utils import parse_pbvc, parse_stats, prefetch
 
-def combineStats(path, subID, sesID):
+def sessionFiles(path, subID, sesID):
     '''
-    This function reads the _samseg.stats file and the _sbtiv.stats file of a session and merges both into a dataframe
+    :return: return the paths of the _samseg.stats file and the _sbtiv.stats file of a session
+    '''
+    prefix = os.path.join(path, "sub-"+subID, "ses-"+sesID, "anat", "sub-"+subID+"_ses-"+sesID)
+    return [prefix + "_samseg.stats", prefix + "_sbtiv.stats"]
+
+def subjectFiles(path, subID):
+    '''
+    :return: return the paths of the _longi_lesions.csv file and the SIENA reports (html, plain-text) of a subject
+    '''
+    prefix = os.path.join(path, "sub-"+subID, "sub-"+subID)
+    return [prefix + "_longi_lesions.csv", prefix + "_PBVC-report.html", prefix + "_PBVC-report.siena"]
+
+def readStats(path, subID, sesID):
+    '''
+    This function reads the _samseg.stats file and the _sbtiv.stats file of a session and merges both into one record
 
     :param path: path to BIDS derviatives database
     :param subID: the subject ID of the session
     :param sesID: the session ID of the session
-    :return: return the volumes in a dataframe
+    :return: return a dictionary with the subject ID, the session ID and the volumes of all ROIs
     '''
-    # define path of stat files and load them as dataframe
-    samseg_path = os.path.join(path, "sub-"+subID, "ses-"+sesID, "anat", "sub-"+subID+"_ses-"+sesID+"_samseg.stats")
-    tiv_path = os.path.join(path, "sub-"+subID, "ses-"+sesID, "anat", "sub-"+subID+"_ses-"+sesID+"_sbtiv.stats")
-    df_samseg_stat = pd.read_csv(samseg_path, header=None, names=["ROI", "volume", "unit"])
-    df_tiv_stat = pd.read_csv(tiv_path, header=None, names=["ROI", "volume", "unit"])
-
-    # combine _samseg and _sbtiv and clean ROI names
-    df = pd.concat([df_samseg_stat, df_tiv_stat])
-    df["ROI"]=df["ROI"].str.replace("# Measure ","")
-    # transpose dataframe and clean indices and column names
-    df = df.loc[:,["ROI", "volume"]].reset_index().drop("index", axis=1)
-    df = df.transpose()
-    df.columns = list(df.iloc[0,0:])
-    df = df.drop(index = 'ROI').reset_index().drop("index", axis=1)
-    # add subject ID and session ID to the dataframe
-    df["sub-ID"] = subID
-    df["ses-ID"]= sesID
-    df_IDs=df[["sub-ID", "ses-ID"]]
-    df.drop(labels=["sub-ID", "ses-ID"], axis=1, inplace=True)
-    df.insert(0, "ses-ID", df_IDs["ses-ID"])
-    df.insert(0, "sub-ID", df_IDs["sub-ID"])
+    samseg_path, tiv_path = sessionFiles(path, subID, sesID)
+    return {"sub-ID": subID, "ses-ID": sesID, **parse_stats(samseg_path), **parse_stats(tiv_path)}
 
-    return df
+def readLesions(path, subID):
+    '''
+    This function reads the _longi_lesions.csv file of a subject (with the pbvc value recorded by the pipeline, or
+    read from the SIENA reports for subjects processed before the pbvc was recorded)
+
+    :param path: path to BIDS derviatives database
+    :param subID: the subject ID
+    :return: return the longitudinal lesion data and the pbvc value of the subject as list of records
+    '''
+    lesion_path, html_path, siena_path = subjectFiles(path, subID)
+    df = pd.read_csv(lesion_path)
+    # append pbvc value
+    if "pbvc" not in df.columns:
+        df["pbvc"] = parse_pbvc(html_path, siena_path)
+    df["sub-ID"] = subID
+    return df.to_dict("records")
 
 ####################################################
 # main script
@@ -46,6 +58,7 @@ def combineStats(path, subID, sesID):
 parser = argparse.ArgumentParser(description='Read Volumes of SAMSEG Longitudinal Segmentation.')
 parser.add_argument('-i', '--input_directory', help='Folder of derivatives in BIDS database.', required=True)
 parser.add_argument('-o', '--output_directory', help='Destination folder for the output table with volume stats.', required=True)
+parser.add_argument('-n', '--number_of_threads', help='Number of files read concurrently.', type=int, default=16)
 
 # read the arguments
 args = parser.parse_args()
@@ -53,19 +66,56 @@ args = parser.parse_args()
 # define path of the derivatives folder
 derivatives_dir = os.path.join(args.input_directory, "derivatives/samseg-longitudinal-7.3.2")
 
-# get a list with the paths of the _seg.mgz files 
+# get the sessions with a _seg.mgz file from the layout index of the derivatives (cached in the output folder)
 # (we do this because we only want subject- and session-IDs for the cases that have been successfully segmented by SAMSEG)
-seg_list = getSegList(derivatives_dir)
-# initialize empty dataframe into which we will write the stats data of all cases
-df_stat = pd.DataFrame()
-for i in range(len(seg_list)):
-    # get subject and session ID
-    subjectID = getSubjectID(seg_list[i])
-    sessionID = getSessionID(seg_list[i])
-    # get stats of current session
-    loop_stat = combineStats(derivatives_dir, subjectID, sessionID)
-    # write stats in the final dataframe
-    df_stat = pd.concat([df_stat, loop_stat])
+layout = BidsLayout(derivatives_dir, cache_file=os.path.join(args.output_directory, "layout_index.json"),
+                    max_workers=args.number_of_threads)
+sessions = [(subID, sesID) for subID in layout.subjects() for sesID in layout.sessions(subID)
+            if layout.files(subID, "seg", sesID, extensions=(".mgz",))]
+# get all sub-IDs (in order of appearance)
+sub_ls = list(dict.fromkeys(subID for subID, _ in sessions))
+
+# records of the sessions (volumes) and of the subjects (lesion data)
+keys = [("stats", subID, sesID) for subID, sesID in sessions] + [("lesions", subID, "") for subID in sub_ls]
+tasks = [(readStats, derivatives_dir, subID, sesID) for subID, sesID in sessions] + \
+        [(readLesions, derivatives_dir, subID) for subID in sub_ls]
+sources = [sessionFiles(derivatives_dir, subID, sesID) for subID, sesID in sessions] + \
+          [subjectFiles(derivatives_dir, subID) for subID in sub_ls]
+
+# only (re)parse the records whose files are new or changed since the last run (see results_store.py)
+store = ResultsStore(os.path.join(args.output_directory, "results.sqlite"))
+signatures = [x for x, _ in prefetch([(ResultsStore.signatures, x) for x in sources], max_workers=args.number_of_threads)]
+results = [(store.lookup(key, x), None) for key, x in zip(keys, signatures)]
+changed = [i for i, (record, _) in enumerate(results) if record is None]
+# read the changed files concurrently
+for i, (record, error) in zip(changed, prefetch([tasks[i] for i in changed], max_workers=args.number_of_threads)):
+    results[i] = (record, error)
+    if error is None:
+        store.put(keys[i], signatures[i], record)
+removed = store.prune(keys)
+store.close()
+print(f'{len(changed)}/{len(keys)} records parsed, {len(keys) - len(changed)} taken from the results store'
+      + (f', {removed} removed' if removed else ''))
+
+# report missing or corrupt files, subjects with incomplete data are left out of the table
+errors = [[task[2], task[3] if len(task) > 3 else "", task[0].__name__, error]
+          for task, (_, error) in zip(tasks, results) if error is not None]
+failed = {x[0] for x in errors}
+errors_file = os.path.join(args.output_directory, "analysis_errors.csv")
+if errors:
+    pd.DataFrame(errors, columns=["sub-ID", "ses-ID", "reader", "error"]).to_csv(errors_file, index=False)
+    print(f'{len(failed)}/{len(sub_ls)} subjects left out because of missing or corrupt files (see {errors_file}):')
+    for subID, sesID, reader, error in errors:
+        print(f'  sub-{subID}{" ses-" + sesID if sesID else ""} ({reader}): {error}')
+elif os.path.exists(errors_file):
+    os.remove(errors_file)
+if len(failed) == len(sub_ls):
+    raise SystemExit('no subject could be read completely, no table written')
+results_stat = results[:len(sessions)]
+results_lesions = results[len(sessions):]
+
+# build the stats table of all sessions in one call
+df_stat = pd.DataFrame.from_records([record for (subID, _), (record, _) in zip(sessions, results_stat) if subID not in failed])
 
 # write stats table to .csv file in chosen output directory
 # df_stat.to_csv(os.path.join(args.output_directory, "volume_stats.csv"), index=False)
@@ -75,33 +125,12 @@ for i in range(len(seg_list)):
 # (e.g., the data of different timepoints of the same subject are next to each other and no more one above/below the other)
 # and gather the longitudinal lesion data of each case and put them in one dataframe
 
-# initialize empty dataframe
-df_vol1 = pd.DataFrame(columns = df_stat.columns)
-df_vol2 = pd.DataFrame(columns = df_stat.columns)
-df_lesions = pd.DataFrame()
-# get all sub-IDs that ar ein the volume_stats file
-sub_ls = []
-[sub_ls.append(x) for x in list(df_stat["sub-ID"]) if x not in sub_ls]
-
-# iteratet hrough all subjects and disentangle the volume dataframe and 
-# combine longitudinal lesion data in one dataframe  
-for i in range(len(sub_ls)):
-    loop_subID = sub_ls[i]
-    ## volume data
-    loop_vol = df_stat[df_stat["sub-ID"]==loop_subID]
-    # create two separate dataframes for timepoint 1 and timepoint 2
-    df_vol1 = pd.concat([df_vol1, loop_vol[loop_vol["ses-ID"]==np.min(loop_vol["ses-ID"])]])
-    df_vol2 = pd.concat([df_vol2, loop_vol[loop_vol["ses-ID"]==np.max(loop_vol["ses-ID"])]])
-    ## longitudinal lesion data
-    # get lesion data of current subject
-    loop_lesion = pd.read_csv(os.path.join(derivatives_dir, "sub-"+loop_subID, "sub-"+loop_subID+"_longi_lesions.csv"))
-    # append pbvc value
-    loop_lesion["pbvc"] = parse_pbvc_from_html_fsl(os.path.join(derivatives_dir, "sub-"+loop_subID, f"sub-{loop_subID}_PBVC-report.html"))
-    loop_lesion["sub-ID"] = loop_subID
-    # write stats in the final dataframe
-    df_lesions = pd.concat([df_lesions, loop_lesion])
-
 ## volume data
+# select the first (timepoint 1) and the last (timepoint 2) session of every subject
+# (the session IDs are ranked as strings, i.e., the same order as the min/max of the IDs)
+ses_rank = df_stat["ses-ID"].astype("category").cat.codes.groupby(df_stat["sub-ID"], sort=False)
+df_vol1 = df_stat.loc[ses_rank.idxmin()]
+df_vol2 = df_stat.loc[ses_rank.idxmax()]
 # add label of timepoint 1 or timepoint 2 to column names (keep sub-ID without label)
 df_vol1 = df_vol1.add_suffix(".t1").rename(columns={"sub-ID.t1":"sub-ID"})
 df_vol2 = df_vol2.add_suffix(".t2").rename(columns={"sub-ID.t2":"sub-ID"})
@@ -112,8 +141,9 @@ df_stat_flat = pd.merge(df_vol1, df_vol2, how = 'inner', on = 'sub-ID')
 #df_stat_flat.to_csv(os.path.join(args.output_directory, "volume_stats_flat.csv"), index=False)
 
 ## longitudinal lesion data
-# rename columns
-df_lesions.columns = loop_lesion.columns
+# build the lesion table of all subjects in one call
+df_lesions = pd.DataFrame.from_records([x for subID, (records, _) in zip(sub_ls, results_lesions) if subID not in failed
+                                        for x in records])
 #write lesion data to csv file 
 # df_lesions.to_csv(os.path.join(args.output_directory, "lesion_stats.csv"), index=False)
 
@@ -121,4 +151,4 @@ df_lesions.columns = loop_lesion.columns
 # merge volume and lesion data
 df_vol_lesion = pd.merge(df_stat_flat, df_lesions, how = 'inner', on = 'sub-ID')
 # write merged data to csv file
-df_vol_lesion.to_csv(os.path.join(args.output_directory, "volume_lesion_stats.csv"), index=False)
\ No newline at end of file
+df_vol_lesion.to_csv(os.path.join(args.output_directory, "volume_lesion_stats.csv"), index=False)
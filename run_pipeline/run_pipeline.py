@@ -3,99 +3,180 @@ import os
 import shutil
 from pathlib import Path
 import multiprocessing
-from utils import getSessionID, getSubjectID, MoveandCheck, split_list
+import cProfile
+import pstats
+import time
+from datetime import datetime
+from contextlib import nullcontext
+from functools import partial
+from claims import WorkClaims
+from events import log_event, stage_timer, summarize_events
+from layout import NIFTI, BidsLayout
+from manifest import file_signature, load_manifest, plan_stages, record_stage, relocate, save_manifest, tool_version
+from preflight import preflight
+from scheduler import peak_memory_gb, plan_resources, read_meminfo, run_admitted
+from runner import STAGE_TIMEOUTS, ToolRunner, build_environment
+from utils import getSessionID, getSubjectID, move_files, parse_pbvc, run_stage_graph, write_summary
 from samseg_stats import generate_samseg_stats
+from tool_cache import ToolCache
 
-def process_samseg(dirs, derivatives_dir, freesurfer_path, fsl_path, remove_temp=False):
+# layout index of the BIDS folder, handed to the workers once by init_worker (see layout.py)
+_layout = None
 
-    for dir in dirs:
+def init_worker(layout):
+    global _layout
+    _layout = layout
 
-        ### assemble T1w and FLAIR file lists
-        t1w = sorted(list(Path(dir).rglob('*T1w*')))
-        flair = sorted(list(Path(dir).rglob('*FLAIR*')))
+def process_samseg(dir, derivatives_dir, freesurfer_path, fsl_path, remove_temp=False, force_stages=(), env=None,
+                   timeouts=None, retries=1, run_id=None, profile=False, threads=4, scratch_dir=None,
+                   cache_dir=None, cache_max_gb=None, compress_level=6, tools_per_subject=1):
+    '''
+    This function runs the longitudinal SAMSEG pipeline (registration, SAMSEG, SIENA and lesion stats) for one subject
 
-        t1w = [str(x) for x in t1w]
-        flair = [str(x) for x in flair]
+    :param dir: path to the subject folder in the BIDS database
+    :param derivatives_dir: path to the samseg derivatives folder
+    :param freesurfer_path: path to freesurfer binaries
+    :param fsl_path: path to FSL binaries
+    :param remove_temp: delete the temp folder after processing
+    :param force_stages: stages to rerun even if they were completed in a previous run (see manifest.py)
+    :param env: environment of the external tools (built from freesurfer_path and fsl_path if not given)
+    :param timeouts: dictionary of timeouts in seconds per stage (see runner.STAGE_TIMEOUTS)
+    :param retries: number of retries of a tool after a transient failure (timeout or killed)
+    :param run_id: identifier of the pipeline run, stored with the stage timings (see events.py)
+    :param profile: run generate_samseg_stats under cProfile
+    :param threads: number of cores of the subject, split among the tools running at the same time (SAMSEG --threads,
+                    OpenMP/ITK)
+    :param scratch_dir: node-local folder the inputs are copied to and the tools are run in (default: the temp folder
+                        in the derivatives), the results are moved to the derivatives and the folder is always removed
+    :param cache_dir: folder of the cache of the registration outputs (see tool_cache.py, default: no cache)
+    :param cache_max_gb: size limit of the cache in GB
+    :param compress_level: gzip compression level of the lesion label maps (1: fastest, 9: smallest)
+    :param tools_per_subject: maximum number of external tools of the subject running at the same time
+    :return: return the subject folder, a success flag and a status message
+    '''
 
-        try:
+    ### assemble T1w and FLAIR file lists (sorted by session)
+    layout = _layout if _layout is not None else BidsLayout(os.path.dirname(dir), subjects=[os.path.basename(dir)])
+    t1w = layout.files(os.path.basename(dir)[4:], 'T1w', extensions=NIFTI)
+    flair = layout.files(os.path.basename(dir)[4:], 'FLAIR', extensions=NIFTI)
+    scratch_subject_dir = os.path.join(os.path.abspath(scratch_dir), os.path.basename(dir)) if scratch_dir else None
 
-            if (len(t1w) != len(flair)) or (len(t1w) <= 1) or (len(flair) <= 1):
-                # instead of using assert we use this mechanism due to parallel processing
-                # assert len(t1w) == len(flair), 'Mismatch T1w/FLAIR number'
-                # we do not check for file corresondance as lists are sorted anyway
-                print(f"Fatal Error for {dir}")
-                break
+    try:
 
+        if (len(t1w) != len(flair)) or (len(t1w) <= 1) or (len(flair) <= 1):
+            # instead of using assert we use this mechanism due to parallel processing
+            # assert len(t1w) == len(flair), 'Mismatch T1w/FLAIR number'
+            # we do not check for file corresondance as lists are sorted anyway
+            print(f"Fatal Error for {dir}")
+            return dir, False, 'Mismatch T1w/FLAIR number or single timepoint'
+
+        ### perform registartion with both T1w images
+        # do the registration in a template folder and distribute its results to BIDS conform output directories later
+        # create template folder
+        #print(t1w)
+        derivatives_temp_dir = os.path.join(derivatives_dir, f'sub-{getSubjectID(t1w[0])}', 'temp')
+        # with a scratch folder, the tools read copies of the inputs and write their outputs on node-local storage
+        if scratch_subject_dir is not None:
+            temp_dir = os.path.join(scratch_subject_dir, 'temp')
+            t1w_in = [os.path.join(scratch_subject_dir, 'input', os.path.basename(x)) for x in t1w]
+            flair_in = [os.path.join(scratch_subject_dir, 'input', os.path.basename(x)) for x in flair]
+        else:
+            temp_dir = derivatives_temp_dir
+            t1w_in, flair_in = t1w, flair
+        print(temp_dir)
+        temp_dir_output = os.path.join(temp_dir, "output")
+        print(temp_dir_output)
+        # pre-define paths of registered images 
+        t1w_reg = [str(Path(x).name).replace("T1w.nii.gz", "space-common_T1w.mgz") for x in t1w]
+        flair_reg_field = [str(Path(x).name).replace("FLAIR.nii.gz", "space-common_FLAIR.lta") for x in flair]
+        flair_reg = [str(Path(x).name).replace("FLAIR.nii.gz", "space-common_FLAIR.mgz") for x in flair]
+        # generate a derivative folder for each session (BIDS)
+        for i in range(len(t1w)):
+            deriv_ses = os.path.join(derivatives_dir, f'sub-{getSubjectID(t1w[i])}', f'ses-{getSessionID(t1w[i])}', 'anat')
+            Path(deriv_ses).mkdir(parents=True, exist_ok=True)
+        print(getSubjectID(t1w[0]))
+
+        # the processing of a subject is expressed as a small dependency graph (see stages below),
+        # independent stages (e.g. coregistration of different timepoints, SIENA and SAMSEG) run concurrently
+        # external tools are run with argument lists in the temp folder, their output goes to sub-<ID>/logs
+        # at most tools_per_subject of them run at once, each with an equal share of the threads of the subject,
+        # so a subject never uses more than `threads` cores
+        tool_threads = max(1, threads // tools_per_subject)
+        runner = ToolRunner(env if env is not None else build_environment(freesurfer_path, fsl_path, tool_threads),
+                            os.path.join(derivatives_dir, f'sub-{getSubjectID(t1w[0])}', 'logs'),
+                            timeouts=timeouts, retries=retries, max_tools=tools_per_subject)
+
+        # the registration outputs are restored from the cache if the same command already ran on the same images
+        # (e.g. when a cohort is rerun with other SAMSEG flags, see tool_cache.py)
+        cache = ToolCache(cache_dir, cache_max_gb) if cache_dir else None
+
+        def run_cached(stage, args, inputs, outputs):
+            if cache is None:
+                runner.run(stage, args, cwd=temp_dir)
+                return
+            key = cache.key(args, inputs, outputs, freesurfer_version, cwd=temp_dir)
+            paths = [os.path.join(temp_dir, x) for x in outputs]
+            if cache.restore(key, paths):
+                print(f'sub-{getSubjectID(t1w[0])}: {stage} restored from the cache')
+                return
+            # outputs restored earlier are hardlinks into the cache, they must not be overwritten in place
+            for x in paths:
+                if os.path.exists(x):
+                    os.remove(x)
+            runner.run(stage, args, cwd=temp_dir)
+            cache.store(key, paths, {'tool': args[0], 'args': args})
+
+        def template():
             ### perform registartion with both T1w images
-            # do the registration in a template folder and distribute its results to BIDS conform output directories later
-            # create template folder
-            #print(t1w)
-            temp_dir = os.path.join(derivatives_dir, f'sub-{getSubjectID(t1w[0])}', 'temp')
-            print(temp_dir)
-            temp_dir_output = os.path.join(temp_dir, "output")
-            print(temp_dir_output)
-            Path(temp_dir_output).mkdir(parents=True, exist_ok=True)
-            # pre-define paths of registered images 
-            t1w_reg = [str(Path(x).name).replace("T1w.nii.gz", "space-common_T1w.mgz") for x in t1w]
-            flair_reg_field = [str(Path(x).name).replace("FLAIR.nii.gz", "space-common_FLAIR.lta") for x in flair]
-            flair_reg = [str(Path(x).name).replace("FLAIR.nii.gz", "space-common_FLAIR.mgz") for x in flair]
-            # call SAMSEG 
-            print(getSubjectID(t1w[0]))
-            os.system(f'export FREESURFER_HOME={freesurfer_path} ; \
-                        cd {temp_dir}; \
-                        mri_robust_template --mov {" ".join(map(str, t1w))} --template mean.mgz --satit --mapmov {" ".join(map(str, t1w_reg))};\
-                        ')        
-            
-
-            ### co-register flairs to their corresponding registered T1w images
-            # initialize an empty list fo timepoint argument for samseg that will be used later
+            run_cached('template', ['mri_robust_template', '--mov', *t1w_in, '--template', 'mean.mgz', '--satit', '--mapmov', *t1w_reg],
+                       t1w_in, ['mean.mgz'] + t1w_reg)
+
+        ### co-register flairs to their corresponding registered T1w images
+        def coreg(i):
+            # get transformation
+            run_cached(f'coreg_{i}', ['mri_coreg', '--mov', flair_in[i], '--ref', t1w_reg[i], '--reg', flair_reg_field[i]],
+                       [flair_in[i], t1w_reg[i]], [flair_reg_field[i]])
+
+        def vol2vol(i):
+            # apply transformation
+            run_cached(f'vol2vol_{i}', ['mri_vol2vol', '--mov', flair_in[i], '--reg', flair_reg_field[i], '--o', flair_reg[i], '--targ', t1w_reg[i]],
+                       [flair_in[i], flair_reg_field[i], t1w_reg[i]], [flair_reg[i]])
+
+        def samseg():
+            ### run SAMSEG longitudinal segmentation
+            # generate timepoint arguments for samseg
             cmd_arg = []
-            # iterate over all timepoints and call SAMSEG
             for i in range(len(flair)):
-                # get transformation
-                os.system(f'export FREESURFER_HOME={freesurfer_path} ; \
-                            cd {temp_dir}; \
-                            mri_coreg --mov {flair[i]} --ref {t1w_reg[i]} --reg {flair_reg_field[i]};\
-                            ')
-
-                # apply transformation
-                os.system(f'export FREESURFER_HOME={freesurfer_path} ; \
-                            cd {temp_dir}; \
-                            mri_vol2vol --mov {flair[i]} --reg {flair_reg_field[i]} --o {flair_reg[i]} --targ {t1w_reg[i]};\
-                            ')
-
-                # generate timepoint argument for samseg
-                cmd_arg.append(f'--timepoint {t1w_reg[i]} {flair_reg[i]}') 
-
-                # generate a derivative folder for each session (BIDS)
-                deriv_ses = os.path.join(derivatives_dir, f'sub-{getSubjectID(t1w[i])}', f'ses-{getSessionID(t1w[i])}', 'anat')
-                Path(deriv_ses).mkdir(parents=True, exist_ok=True)
-
-            ### run SAMSEG longitudinal segmentation 
-            os.system(f'export FREESURFER_HOME={freesurfer_path} ; \
-                        cd {temp_dir}; \
-                        run_samseg_long {" ".join(map(str, cmd_arg))} --threads 4 --pallidum-separate --lesion --lesion-mask-pattern 0 1 -o output/\
-                        ')
-            
-            ### run FSL-SIENA to calculate PBVC
-            os.system(f'FSLDIR={fsl_path};\
-                        . ${{FSLDIR}}/etc/fslconf/fsl.sh;\
-                        PATH=${{FSLDIR}}/bin:${{PATH}};\
-                        export FSLDIR PATH;\
-                        {fsl_path}/bin/siena {Path(t1w[0])} {Path(t1w[1])} -o {temp_dir} -B "-f 0.2 -B"')
+                cmd_arg += ['--timepoint', t1w_reg[i], flair_reg[i]]
+            runner.run('samseg', ['run_samseg_long', *cmd_arg, '--threads', str(tool_threads), '--pallidum-separate', '--lesion',
+                                  '--lesion-mask-pattern', '0', '1', '-o', 'output/'],
+                       cwd=temp_dir)
+
+        def siena():
+            ### run FSL-SIENA to calculate PBVC (only needs the original T1w images)
+            runner.run('siena', [os.path.join(fsl_path, 'bin', 'siena'), t1w_in[0], t1w_in[1], '-o', temp_dir, '-B', '-f 0.2 -B'],
+                       cwd=temp_dir)
 
+        # files moved by the fan-out stages (original path: target path), kept in the manifest
+        moved = {'fanout_samseg': {}, 'fanout_siena': {}}
+        moved_bytes = {'fanout_samseg': 0, 'fanout_siena': 0}
+
+        def fanout_move(stage, pairs):
+            # all files of a stage are moved in one pass (renamed on the same file system, see utils.move_files)
+            moved_bytes[stage] += move_files(pairs)
+            moved[stage].update(pairs)
+
+        def fanout_samseg():
             ### copy output files from temp folder to their session folders
             # write paths of output folders of the timepoint (tp) in a list
             tp_folder = sorted(list(str(x) for x in os.listdir(temp_dir_output) if "tp" in str(x)))
+            # (original path, target path) of all files, moved together at the end
+            pairs = []
 
-            # copy the mean image file and pbvc files
+            # copy the mean image file
             mean_temp_location = os.path.join(temp_dir, "mean.mgz")
             mean_target_location = os.path.join(derivatives_dir, f'sub-{getSubjectID(t1w_reg[0])}', f'sub-{getSubjectID(t1w_reg[0])}' + '_mean.mgz')
-            MoveandCheck(mean_temp_location, mean_target_location)
-            # copy the SIENA PBVC html report
-            pbvc_temp_location = os.path.join(temp_dir, "report.html")
-            pbvc_target_location = os.path.join(derivatives_dir, f'sub-{getSubjectID(t1w_reg[0])}', f'sub-{getSubjectID(t1w_reg[0])}' + '_PBVC-report.html')
-            MoveandCheck(pbvc_temp_location, pbvc_target_location)
+            pairs.append((mean_temp_location, mean_target_location))
 
             # only continue if more than one timepoint was segmented
             # aggregate the samseg output files and move to appropriate directories
@@ -131,49 +212,228 @@ def process_samseg(dirs, derivatives_dir, freesurfer_path, fsl_path, remove_temp
                     flair_reg_field_ses_location = os.path.join(deriv_ses, flair_reg_field[i])
                     
                     # copy files from template output folder to target output folder (one output folder per session)
-                    # each time there is a check if the file in the temp folder exists and if it  was copied successfully
                     # T1w
-                    MoveandCheck(t1w_reg_temp_location, t1w_reg_ses_location)
+                    pairs.append((t1w_reg_temp_location, t1w_reg_ses_location))
                     # FLAIR
-                    MoveandCheck(flair_reg_temp_location, flair_reg_ses_location)
+                    pairs.append((flair_reg_temp_location, flair_reg_ses_location))
                     # FLAIR transformation file
-                    MoveandCheck(flair_reg_field_temp_location, flair_reg_field_ses_location)
+                    pairs.append((flair_reg_field_temp_location, flair_reg_field_ses_location))
                     # copy output files to target folder
-                    for i in range(len(tp_files_temp_path)):
-                        MoveandCheck(tp_files_temp_path[i], tp_files_ses_path[i])
+                    pairs += list(zip(tp_files_temp_path, tp_files_ses_path))
             else:
                 print(f'Skipping longitudinal data copies.')
 
-            if remove_temp:
+            # it is checked once that all files exist in the temp folder and were moved successfully
+            fanout_move('fanout_samseg', pairs)
+            print(f'moved {len(pairs)} files to {os.path.join(derivatives_dir, f"sub-{getSubjectID(t1w_reg[0])}")}')
+
+        pbvc_html_location = os.path.join(derivatives_dir, f'sub-{getSubjectID(t1w_reg[0])}', f'sub-{getSubjectID(t1w_reg[0])}' + '_PBVC-report.html')
+        pbvc_siena_location = os.path.join(derivatives_dir, f'sub-{getSubjectID(t1w_reg[0])}', f'sub-{getSubjectID(t1w_reg[0])}' + '_PBVC-report.siena')
+
+        def fanout_siena():
+            # copy the SIENA PBVC html report and the plain-text report (if SIENA wrote it)
+            pairs = [(os.path.join(temp_dir, "report.html"), pbvc_html_location)]
+            if os.path.exists(os.path.join(temp_dir, "report.siena")):
+                pairs.append((os.path.join(temp_dir, "report.siena"), pbvc_siena_location))
+            fanout_move('fanout_siena', pairs)
+
+        def cleanup():
+            if remove_temp and os.path.exists(temp_dir):
                 # delete the temp folder
                 shutil.rmtree(temp_dir)
                 if os.path.exists(temp_dir):
                     raise ValueError(f'failed to delete the template folder: {temp_dir}')
                 else:
                     print(f'successfully deleted the template folder: {temp_dir}')
-    
-            # generate the actual samseg volumetric stats
-
-            filename = f'sub-{getSubjectID(t1w[0])}_ses-{getSessionID(t1w[0])}_seg.mgz'
-            bl_path = os.path.join(derivatives_dir, f'sub-{getSubjectID(t1w[0])}', f'ses-{getSessionID(t1w[0])}', 'anat', filename)
-            filename = f'sub-{getSubjectID(t1w[1])}_ses-{getSessionID(t1w[1])}_seg.mgz'
-            fu_path = os.path.join(derivatives_dir, f'sub-{getSubjectID(t1w[1])}', f'ses-{getSessionID(t1w[1])}', 'anat', filename)
-            output_path = os.path.join(derivatives_dir, f'sub-{getSubjectID(t1w[0])}')
-            generate_samseg_stats(bl_path=bl_path, fu_path=fu_path, output_path=output_path)
-        except:
-            print("Error occured during processing, proceeding with next subject.")
-            
+
+        # generate the actual samseg volumetric stats
+        filename = f'sub-{getSubjectID(t1w[0])}_ses-{getSessionID(t1w[0])}_seg.mgz'
+        bl_path = os.path.join(derivatives_dir, f'sub-{getSubjectID(t1w[0])}', f'ses-{getSessionID(t1w[0])}', 'anat', filename)
+        filename = f'sub-{getSubjectID(t1w[1])}_ses-{getSessionID(t1w[1])}_seg.mgz'
+        fu_path = os.path.join(derivatives_dir, f'sub-{getSubjectID(t1w[1])}', f'ses-{getSessionID(t1w[1])}', 'anat', filename)
+        output_path = os.path.join(derivatives_dir, f'sub-{getSubjectID(t1w[0])}')
+
+        def stats():
+            # the PBVC is written to the lesion csv, next to the lesion stats
+            pbvc = parse_pbvc(pbvc_html_location, pbvc_siena_location)
+            if profile:
+                # profile the python part of the pipeline, the results are written to sub-<ID>/logs
+                profiler = cProfile.Profile()
+                profiler.runcall(generate_samseg_stats, bl_path=bl_path, fu_path=fu_path, output_path=output_path, pbvc=pbvc,
+                                 compress_level=compress_level)
+                profiler.dump_stats(os.path.join(runner.log_dir, 'stats.prof'))
+                with open(os.path.join(runner.log_dir, 'stats_profile.txt'), 'w') as f:
+                    pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(40)
+            else:
+                generate_samseg_stats(bl_path=bl_path, fu_path=fu_path, output_path=output_path, pbvc=pbvc,
+                                      compress_level=compress_level)
+
+        # stage name: (function, stages it depends on)
+        stages = {'template': (template, [])}
+        for i in range(len(flair)):
+            stages[f'coreg_{i}'] = (partial(coreg, i), ['template'])
+            stages[f'vol2vol_{i}'] = (partial(vol2vol, i), [f'coreg_{i}'])
+        stages['samseg'] = (samseg, [f'vol2vol_{i}' for i in range(len(flair))])
+        stages['siena'] = (siena, [])
+        stages['fanout_samseg'] = (fanout_samseg, ['samseg'])
+        stages['fanout_siena'] = (fanout_siena, ['siena'])
+        stages['stats'] = (stats, ['fanout_samseg', 'fanout_siena'])
+        stages['cleanup'] = (cleanup, ['fanout_samseg', 'fanout_siena'])
+
+        ### skip the stages that were already completed in a previous run (see manifest.py)
+        # inputs and outputs of each stage, used to check whether a stage has to be rerun
+        def in_temp(filenames):
+            return [os.path.join(temp_dir, x) for x in filenames]
+
+        def samseg_outputs():
+            # only the timepoint folders are kept (moved by the fan-out)
+            tp_folder = [os.path.join(temp_dir_output, x) for x in sorted(os.listdir(temp_dir_output)) if "tp" in x]
+            return [os.path.join(x, f) for x in tp_folder for f in sorted(os.listdir(x))]
+
+        sub_prefix = os.path.join(output_path, f'sub-{getSubjectID(t1w[0])}')
+        stage_files = {'template': (t1w, in_temp(["mean.mgz"] + t1w_reg))}
+        for i in range(len(flair)):
+            stage_files[f'coreg_{i}'] = ([flair[i]] + in_temp([t1w_reg[i]]), in_temp([flair_reg_field[i]]))
+            stage_files[f'vol2vol_{i}'] = ([flair[i]] + in_temp([flair_reg_field[i], t1w_reg[i]]), in_temp([flair_reg[i]]))
+        stage_files['samseg'] = (in_temp(t1w_reg + flair_reg), samseg_outputs)
+        stage_files['siena'] = (t1w[:2], in_temp(["report.html"]))
+        stage_files['fanout_samseg'] = ([], lambda: moved['fanout_samseg'].values())
+        stage_files['fanout_siena'] = ([], lambda: moved['fanout_siena'].values())
+        stage_files['stats'] = ([bl_path, fu_path], [sub_prefix + x for x in ["_longi_lesions.csv", "_longi_lesions.npz"]])
+        stage_files['cleanup'] = ([], [])
+
+        freesurfer_version = tool_version(os.path.join(freesurfer_path, 'build-stamp.txt'))
+        versions = {name: freesurfer_version for name in stages}
+        versions['siena'] = tool_version(os.path.join(fsl_path, 'etc', 'fslversion'))
+        for name in ['fanout_samseg', 'fanout_siena', 'stats', 'cleanup']:
+            versions[name] = 'pipeline'
+
+        manifest_path = sub_prefix + '_manifest.json'
+        manifest = load_manifest(manifest_path)
+        # the recorded temp files are looked up in the temp folder of this run (scratch or derivatives)
+        relocate(manifest, temp_dir, derivatives_temp_dir)
+        # the cleanup is cheap and always done
+        rerun = plan_stages(manifest, {name: deps for name, (_, deps) in stages.items()}, versions,
+                            force_stages=tuple(force_stages) + ('cleanup',))
+        # invalidate the records of the stages that will be rerun, so that an interrupted run is never mistaken as complete
+        for name in rerun:
+            manifest['stages'].pop(name, None)
+        save_manifest(manifest_path, manifest)
+
+        # every stage is timed and logged to sub-<ID>_events.jsonl (see events.py)
+        events_path = sub_prefix + '_events.jsonl'
+
+        def tracked(name, function):
+            def run():
+                event = {'run': run_id, 'subject': f'sub-{getSubjectID(t1w[0])}', 'stage': name,
+                         'start': datetime.now().isoformat(timespec='milliseconds'), 'worker': os.getpid(), 'status': 'skipped',
+                         'wall': 0.0, 'user': 0.0, 'sys': 0.0, 'maxrss_kb': 0, 'bytes': 0}
+                if name not in rerun:
+                    print(f'sub-{getSubjectID(t1w[0])}: skipping completed stage {name}')
+                    log_event(events_path, event)
+                    return
+                inputs, outputs = stage_files[name]
+                signatures = {x: file_signature(x) for x in inputs}
+                try:
+                    with stage_timer(event):
+                        function()
+                    event['status'] = 'done'
+                except Exception as e:
+                    event['status'] = 'failed'
+                    event['error'] = f'{type(e).__name__}: {e}'
+                    raise
+                finally:
+                    # add the resource usage of the external tool
+                    if name in runner.usage:
+                        event['user'] += runner.usage[name]['user']
+                        event['sys'] += runner.usage[name]['sys']
+                        event['maxrss_kb'] = runner.usage[name]['maxrss_kb']
+                    event['bytes'] = moved_bytes.get(name, 0)
+                    log_event(events_path, event)
+                outputs = outputs() if callable(outputs) else outputs
+                record_stage(manifest_path, manifest, name, signatures, outputs, versions[name], moved.get(name))
+            return run
+
+        # the temp folder is only needed if one of the external tools is rerun
+        if rerun - {'stats', 'cleanup'}:
+            Path(temp_dir_output).mkdir(parents=True, exist_ok=True)
+            if scratch_subject_dir is not None:
+                # stage the input images to the scratch folder in one pass
+                move_files(list(zip(t1w + flair, t1w_in + flair_in)), copy=True)
+        # if a stage fails, the tools still running for this subject are killed so the worker can move on
+        run_stage_graph({name: (tracked(name, function), deps) for name, (function, deps) in stages.items()},
+                        on_failure=runner.terminate)
+        skipped = len(stages) - len(rerun)
+        if scratch_subject_dir is not None and os.path.exists(temp_dir):
+            # the files left in the scratch temp folder (not moved by the fan-out) are kept in the derivatives temp folder
+            move_files([(os.path.join(root, x), os.path.join(derivatives_temp_dir, os.path.relpath(root, temp_dir), x))
+                        for root, _, files in os.walk(temp_dir) for x in files])
+
+    except Exception as e:
+        print("Error occured during processing, proceeding with next subject.")
+        return dir, False, f'{type(e).__name__}: {e}'
+    finally:
+        # the scratch folder is removed in any case (the logs and the manifest are in the derivatives)
+        if scratch_subject_dir is not None:
+            shutil.rmtree(scratch_subject_dir, ignore_errors=True)
+
+    return dir, True, f'ok, {skipped} completed stages skipped' if skipped else 'ok'
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Run SAMSEG Longitudinal Pipeline on cohort.')
     parser.add_argument('-i', '--input_directory', help='Folder of derivatives in BIDS database.', required=True)
-    parser.add_argument('-n', '--number_of_workers', help='Number of parallel processing cores.', type=int, default=os.cpu_count()-1)
+    parser.add_argument('-n', '--number_of_workers', help='Number of subjects processed in parallel (default: derived from --cores, --threads and the memory budget).', type=int, default=None)
+    parser.add_argument('--cores', help='Total number of cores to use.', type=int, default=os.cpu_count())
+    parser.add_argument('--threads', help='Number of threads per subject (default: 4, or cores / number_of_workers).', type=int, default=None)
+    parser.add_argument('--tools_per_subject', help='Number of external tools of one subject running at the same time, '
+                        'each with threads / tools_per_subject threads (default: 1).', type=int, default=1)
+    parser.add_argument('--memory_gb', help='Memory budget in GB (default: 90%% of the total memory).', type=float,
+                        default=0.9 * (read_meminfo('MemTotal') or 64))
+    parser.add_argument('--memory_per_subject_gb', help='Estimated peak memory of one subject in GB (refined with the observed peaks during the run).',
+                        type=float, default=16)
     parser.add_argument('-f', '--freesurfer_path', help='Path to freesurfer binaries.', default='/home/jmcginnis/freesurfer')
     parser.add_argument('-fsl', '--fsl_path', help='Path to FSL binaries.', default='/home/jmcginnis/fsl')
     parser.add_argument('--remove_temp', action='store_true')
+    parser.add_argument('--force-stage', dest='force_stages', nargs='+', default=[],
+                        choices=['all', 'template', 'coreg', 'vol2vol', 'samseg', 'siena', 'fanout', 'stats'],
+                        help='Rerun these stages (and all stages depending on them) even if they were already completed.')
+    parser.add_argument('--timeout', dest='timeouts', nargs='+', default=[], metavar='STAGE=SECONDS',
+                        help=f'Timeouts of the external tools per stage (defaults: {STAGE_TIMEOUTS}).')
+    parser.add_argument('--retries', type=int, default=1,
+                        help='Number of retries of a tool that timed out or was killed.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Run generate_samseg_stats under cProfile (results in sub-*/logs).')
+    parser.add_argument('--compress_level', help='gzip compression level of the lesion label maps (1: fastest, 9: smallest).',
+                        type=int, default=6, choices=range(1, 10))
+    parser.add_argument('--scratch-dir', dest='scratch_dir', default=None,
+                        help='Node-local folder (e.g. /tmp or a local SSD) to run the tools in, the results are moved to the derivatives at the end.')
+    parser.add_argument('--cache-dir', dest='cache_dir', default=None,
+                        help='Cache the outputs of mri_robust_template, mri_coreg and mri_vol2vol in this folder and reuse them for identical inputs.')
+    parser.add_argument('--cache-max-gb', dest='cache_max_gb', type=float, default=None,
+                        help='Size limit of the cache in GB (least recently used entries are removed).')
+    parser.add_argument('--distributed', metavar='RUN_NAME', default=None,
+                        help='Share the cohort with the other run_pipeline.py instances started with the same RUN_NAME (on this or other '
+                             'nodes): subjects are claimed through lease files in derivatives/.../claims/RUN_NAME, every subject is processed once.')
+    parser.add_argument('--lease-seconds', dest='lease_seconds', type=float, default=600,
+                        help='With --distributed: a subject whose lease was not refreshed for this time (crashed instance) is taken over.')
+    parser.add_argument('--preflight', choices=['header', 'full', 'off'], default='header',
+                        help='Check the images of all subjects before scheduling them: headers and gzip trailers (header), '
+                             'additionally decompress all images (full) or no check (off).')
 
     # read the arguments
     args = parser.parse_args()
+    if args.tools_per_subject < 1:
+        parser.error('--tools_per_subject must be at least 1')
+
+    # the tools run in the temp folder of the subject, so all paths handed to them have to be absolute
+    args.input_directory = os.path.abspath(args.input_directory)
+    args.freesurfer_path = os.path.abspath(args.freesurfer_path)
+    args.fsl_path = os.path.abspath(args.fsl_path)
+    if args.scratch_dir is not None:
+        args.scratch_dir = os.path.abspath(args.scratch_dir)
+    if args.cache_dir is not None:
+        args.cache_dir = os.path.abspath(args.cache_dir)
 
     if args.remove_temp:
         remove_temp = True
@@ -183,19 +443,89 @@ if __name__ == "__main__":
     # generate derivatives/labels/
     derivatives_dir = os.path.join(args.input_directory, "derivatives/samseg-longitudinal-7.3.2")
     Path(derivatives_dir).mkdir(parents=True, exist_ok=True)
-    data_root = Path(os.path.join(args.input_directory))
+    # index the subjects, sessions and images once (cached in the derivatives folder, see layout.py)
+    layout = BidsLayout(args.input_directory, cache_file=os.path.join(derivatives_dir, 'bids_layout.json'))
+    # check the images of all subjects before scheduling, so no worker is spent on a subject that can not run
+    if args.preflight != 'off':
+        runnable, preflight_failures = preflight(layout, os.path.join(derivatives_dir, 'preflight_report.csv'),
+                                                 full=args.preflight == 'full')
+        print(f'preflight: {len(runnable)}/{len(layout.subjects())} subjects runnable '
+              f'(report: {os.path.join(derivatives_dir, "preflight_report.csv")})')
+        for x, problems in preflight_failures.items():
+            print(f'  skipped: sub-{x} ({problems})')
+    else:
+        runnable, preflight_failures = layout.subjects(), {}
+    dirs = [layout.subject_dir(x) for x in runnable]
+
+    # stage timings of this run are tagged with run_id
+    run_id = datetime.now().isoformat(timespec='seconds')
+
+    # split the core budget into subjects processed in parallel x threads per subject
+    number_of_workers, threads = plan_resources(args.cores, args.memory_gb, args.memory_per_subject_gb,
+                                                args.number_of_workers, args.threads)
+    print(f'processing {number_of_workers} subjects in parallel with {threads} threads each '
+          f'(memory budget: {args.memory_gb:.1f} GB, {args.memory_per_subject_gb:.1f} GB per subject)')
+
+    # environment of the external tools, built once for all subjects
+    env = build_environment(args.freesurfer_path, args.fsl_path, max(1, threads // args.tools_per_subject))
+    timeouts = {}
+    for x in args.timeouts:
+        stage, seconds = x.split('=')
+        if stage not in STAGE_TIMEOUTS:
+            parser.error(f'unknown stage in --timeout: {stage}')
+        timeouts[stage] = float(seconds)
+
+    # initialize multiprocessing, subjects are handed out one at a time
+    # so that a worker picks up the next subject as soon as it is done with the previous one,
+    # a subject is only started if the memory budget allows it (see scheduler.py)
+    worker = partial(process_samseg, derivatives_dir=derivatives_dir, freesurfer_path=args.freesurfer_path,
+                     fsl_path=args.fsl_path, remove_temp=remove_temp, force_stages=args.force_stages, env=env,
+                     timeouts=timeouts, retries=args.retries, run_id=run_id, profile=args.profile, threads=threads,
+                     scratch_dir=args.scratch_dir, cache_dir=args.cache_dir, cache_max_gb=args.cache_max_gb,
+                     compress_level=args.compress_level, tools_per_subject=args.tools_per_subject)
+
+    def observed_peak(subject_dir):
+        sub = os.path.basename(subject_dir)
+        return peak_memory_gb(os.path.join(derivatives_dir, sub, f'{sub}_events.jsonl'), run_id)
+
+    # with --distributed, every subject is claimed right before it is started (see claims.py)
+    claims = WorkClaims(os.path.join(derivatives_dir, 'claims', args.distributed), lease_seconds=args.lease_seconds) \
+        if args.distributed else None
+
+    def claim(subject_dir):
+        return claims.claim(os.path.basename(subject_dir))
 
-    dirs = sorted(list(data_root.glob('*')))
-    dirs = [str(x) for x in dirs]
-    dirs = [x for x in dirs if "sub-" in x]
-    files = split_list(dirs, args.number_of_workers)
+    results = []
+    pending = dirs
+    with multiprocessing.Pool(processes=number_of_workers, initializer=init_worker, initargs=(layout,)) as pool:
+        with claims if claims is not None else nullcontext():
+            while pending:
+                for result in run_admitted(pool, worker, pending, number_of_workers, args.memory_gb, args.memory_per_subject_gb,
+                                           observed_peak=observed_peak, claim=claim if claims is not None else None):
+                    results.append(result)
+                    subject_dir, success, message = result
+                    if claims is not None and not claims.release(os.path.basename(subject_dir), success, message):
+                        message += ' (lease lost, result not recorded)'
+                    print(f'[{len(results)}/{len(dirs)}] {"done" if success else "FAILED"}: {os.path.basename(subject_dir)} ({message})')
+                if claims is None:
+                    break
+                # the subjects claimed by other instances are waited for, their leases are taken over if they expire
+                pending = [x for x in dirs if claims.done(os.path.basename(x)) is None]
+                if pending:
+                    time.sleep(claims.heartbeat_seconds)
 
-    # initialize multithreading
-    pool = multiprocessing.Pool(processes=args.number_of_workers)
-    # creation, initialisation and launch of the different processes
-    for x in range(0, args.number_of_workers):
-        pool.apply_async(process_samseg, args=(files[x], derivatives_dir, args.freesurfer_path, args.fsl_path, remove_temp))
+    if claims is not None:
+        # the summary covers the subjects processed by all instances
+        done = {x: claims.done(os.path.basename(x)) for x in dirs}
+        results = [(x, done[x]['success'], done[x]['message']) for x in dirs]
 
-    pool.close()
-    pool.join()
+    # per-subject summary (including the subjects that did not pass the preflight check)
+    results += [(layout.subject_dir(x), False, f'preflight: {problems}') for x, problems in preflight_failures.items()]
+    write_summary(results, os.path.join(derivatives_dir, 'pipeline_summary.csv'))
 
+    # cohort-level timing summary of the stages
+    events = [os.path.join(derivatives_dir, os.path.basename(x), f'{os.path.basename(x)}_events.jsonl') for x in dirs]
+    timing = summarize_events(events, run_id=run_id)
+    timing.to_csv(os.path.join(derivatives_dir, f'pipeline_timing_{claims.owner}.csv' if claims is not None else 'pipeline_timing.csv'),
+                  index=False)
+    print(timing.to_string(index=False, float_format='{:.2f}'.format))
@@ -0,0 +1,181 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from scheduler import THREAD_VARIABLES
+
+# default timeouts of the external tools in seconds (per call, keyed by stage)
+STAGE_TIMEOUTS = {
+    'template': 2 * 3600,
+    'coreg': 3600,
+    'vol2vol': 3600,
+    'samseg': 24 * 3600,
+    'siena': 6 * 3600,
+}
+
+
+class ToolError(RuntimeError):
+    '''
+    Raised if an external tool exits with a non-zero exit code, times out or is killed
+    '''
+
+
+def build_environment(freesurfer_path, fsl_path, threads=None):
+    '''
+    This function builds the environment for the FreeSurfer and FSL tools once (instead of exporting
+    FREESURFER_HOME and sourcing fsl.sh for every single call)
+
+    :param freesurfer_path: path to freesurfer installation
+    :param fsl_path: path to FSL installation
+    :param threads: number of threads of the tools (sets the OpenMP/ITK/BLAS thread variables)
+    :return: return the environment as dictionary
+    '''
+    env = dict(os.environ)
+    fsl_conf = os.path.join(fsl_path, 'etc', 'fslconf', 'fsl.sh')
+    if os.path.exists(fsl_conf):
+        # source fsl.sh once and keep the variables it sets (FSLOUTPUTTYPE, ...)
+        out = subprocess.run(['bash', '-c', 'FSLDIR="$1"; . "$FSLDIR/etc/fslconf/fsl.sh"; env -0', 'bash', fsl_path],
+                             env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+        env = dict(x.split('=', 1) for x in out.decode().split('\0') if '=' in x)
+    env['FREESURFER_HOME'] = freesurfer_path
+    env['FSLDIR'] = fsl_path
+    env['PATH'] = os.pathsep.join([os.path.join(fsl_path, 'bin'), os.path.join(freesurfer_path, 'bin'), env.get('PATH', '')])
+    if threads is not None:
+        for variable in THREAD_VARIABLES:
+            env[variable] = str(threads)
+    return env
+
+
+class ToolRunner:
+    '''
+    Runs the external tools of one subject: argument lists instead of shell strings, a fixed working directory,
+    per-stage timeouts, retries of transient failures and stdout/stderr captured to one log file per stage.
+    At most max_tools tools run at the same time (the stages of a subject run concurrently, see run_stage_graph),
+    so the tools of a subject never use more cores than its thread budget.
+    A failing tool raises ToolError, terminate() kills all tools that are still running for the subject.
+    '''
+
+    def __init__(self, env, log_dir, timeouts=None, retries=1, max_tools=None):
+        '''
+        :param env: environment of the tools (see build_environment)
+        :param log_dir: folder for the log files of the subject
+        :param timeouts: dictionary of stage timeouts in seconds (defaults: STAGE_TIMEOUTS)
+        :param retries: number of retries after a transient failure (timeout or tool killed by a signal)
+        :param max_tools: maximum number of tools running at the same time (default: no limit)
+        '''
+        self.env = env
+        self.log_dir = log_dir
+        self.timeouts = {**STAGE_TIMEOUTS, **(timeouts or {})}
+        self.retries = retries
+        self._processes = set()
+        self._slots = threading.BoundedSemaphore(max_tools) if max_tools else None
+        self._lock = threading.Lock()
+        self._terminated = False
+        # resource usage per stage: user/sys CPU time in s and peak RSS in kB
+        self.usage = {}
+
+    def run(self, stage, args, cwd):
+        '''
+        :param stage: name of the stage (e.g. 'coreg_0'), the part before '_' selects the timeout
+        :param args: command as list of arguments
+        :param cwd: working directory
+        '''
+        timeout = self.timeouts.get(stage.split('_')[0])
+        os.makedirs(self.log_dir, exist_ok=True)
+        with open(os.path.join(self.log_dir, f'{stage}.log'), 'a') as log:
+            for attempt in range(self.retries + 1):
+                # wait for a free slot, the timeout only starts when the tool is started
+                with self._slots if self._slots is not None else nullcontext():
+                    log.write(f'### {datetime.now().isoformat(timespec="seconds")} attempt {attempt + 1}: {" ".join(map(str, args))}\n')
+                    log.flush()
+                    returncode, timed_out = self._call(stage, args, cwd, log, timeout)
+                if timed_out:
+                    error = f'{stage}: {os.path.basename(args[0])} timed out after {timeout} s'
+                elif returncode == 0:
+                    return
+                elif returncode > 0:
+                    # the tool reported an error, this is not going to change on a retry
+                    raise ToolError(f'{stage}: {os.path.basename(args[0])} failed with exit code {returncode} (see {log.name})')
+                else:
+                    error = f'{stage}: {os.path.basename(args[0])} was killed by signal {-returncode}'
+                log.write(f'### {error}\n')
+                if self._terminated:
+                    break
+            raise ToolError(f'{error} (see {log.name})')
+
+    def _call(self, stage, args, cwd, log, timeout):
+        with self._lock:
+            if self._terminated:
+                raise ToolError('subject was aborted')
+            # own process group, so that a timeout also kills the processes started by the tool
+            try:
+                process = subprocess.Popen([str(x) for x in args], cwd=cwd, env=self.env, stdout=log,
+                                           stderr=subprocess.STDOUT, start_new_session=True)
+            except OSError as e:
+                raise ToolError(f'could not start {args[0]}: {e}')
+            self._processes.add(process)
+        timed_out = False
+        try:
+            try:
+                returncode, rusage = self._wait(process, timeout)
+            except subprocess.TimeoutExpired:
+                timed_out = True
+                returncode, rusage = self._stop(process)
+        finally:
+            with self._lock:
+                self._processes.discard(process)
+        # resource usage of the tool (and the processes it started), summed over all calls of the stage
+        usage = self.usage.setdefault(stage, {'user': 0.0, 'sys': 0.0, 'maxrss_kb': 0})
+        usage['user'] += rusage.ru_utime
+        usage['sys'] += rusage.ru_stime
+        usage['maxrss_kb'] = max(usage['maxrss_kb'], rusage.ru_maxrss)
+        return returncode, timed_out
+
+    @staticmethod
+    def _wait(process, timeout=None):
+        # os.wait4 instead of process.wait, to get the resource usage of the finished tool
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.01
+        while True:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                process.returncode = os.waitstatus_to_exitcode(status)
+                return process.returncode, rusage
+            if deadline is not None and time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired(process.args, timeout)
+            time.sleep(delay)
+            delay = min(2 * delay, 0.5)
+
+    @staticmethod
+    def _signal(process, sig):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def _stop(self, process):
+        self._signal(process, signal.SIGTERM)
+        try:
+            return self._wait(process, timeout=10)
+        except subprocess.TimeoutExpired:
+            self._signal(process, signal.SIGKILL)
+            return self._wait(process)
+
+    def terminate(self, *args):
+        '''
+        This function kills all running tools of the subject and prevents new ones from being started
+        '''
+        with self._lock:
+            self._terminated = True
+            processes = list(self._processes)
+        # the processes are reaped by the threads that started them
+        for process in processes:
+            self._signal(process, signal.SIGTERM)
+        deadline = time.monotonic() + 10
+        while self._processes and time.monotonic() < deadline:
+            time.sleep(0.1)
+        for process in list(self._processes):
+            self._signal(process, signal.SIGKILL)
@@ -4,14 +4,153 @@ import pandas as pd
 import argparse
 import os
 import sys
+import gzip
 import re
 from scipy import ndimage as ndi
 from skimage.morphology import binary_dilation
 
 from utils import getSubjectID
 
+def load_lesion_mask(path, lesion_label=99):
+    '''
+    This function reads a SAMSEG segmentation once, in its native integer dtype, and returns the lesion mask
+
+    :param path: path to the segmentation (e.g., "*_seg.mgz")
+    :param lesion_label: label of the lesions in the segmentation (99 for SAMSEG)
+    :return: return the boolean lesion mask and the affine of the image
+    '''
+    img = nib.load(path)
+    # read through the array proxy, avoids the float64 copy of get_fdata()
+    lesion_mask = np.asanyarray(img.dataobj) == lesion_label
+    return lesion_mask, img.affine
+
+
+def pad_slices(slices, pad, shape):
+    '''
+    This function enlarges a bounding box (as returned by ndi.find_objects) by pad voxels in every direction,
+    clipped to the volume boundaries
+
+    :param slices: tuple of slices describing the bounding box of a component
+    :param pad: number of voxels to add on each side
+    :param shape: shape of the full volume
+    :return: return the padded tuple of slices
+    '''
+    return tuple(slice(max(s.start - pad, 0), min(s.stop + pad, n)) for s, n in zip(slices, shape))
+
+
+def classify_difference_lesions(lesions, number_of_lesions, reference, ok_sizes, distance_map, voxelsize, min_size, max_overlap,
+                                debug=False, hole_label="Enlarging lesion", solitary_label="New solitary or abutting lesion"):
+    '''
+    This function classifies the connected components of a difference map (fu - bl or bl - fu) into lesions with a hole
+    (enlarging/shrinking) and solitary lesions (new/disappearing). All morphological operations are done inside the
+    bounding box of each component, padded by the dilation radius, so the cost scales with the lesion size and not with
+    the volume size. Components that do not fit the criteria are flagged in ok_sizes (modified in place).
+
+    :param lesions: labelled difference map (output of ndi.label)
+    :param number_of_lesions: number of components in lesions
+    :param reference: binary lesion mask of the other timepoint, used to compute the overlap of the dilated component
+    :param ok_sizes: boolean array (one entry per component) of components passing the pre-selection
+    :param distance_map: euclidean distance map of the difference map
+    :param voxelsize: voxel volume in mm^3
+    :param min_size: minimum lesion volume in mm^3
+    :param max_overlap: maximum overlap between the dilated component and the reference (fraction of its volume)
+    :param debug: print per-component information
+    :param hole_label: debug message for components with a hole
+    :param solitary_label: debug message for solitary components
+    :return: return the number of components with a hole and the number of solitary components
+    '''
+    hole_lesions = 0
+    solitary_lesions = 0
+    # pad by one voxel, the radius of the (default) dilation footprint
+    objects = ndi.find_objects(lesions, max_label=number_of_lesions)
+    for lesion_number in range(1, number_of_lesions + 1):
+
+        if not ok_sizes[lesion_number - 1]:
+            continue
+
+        crop = pad_slices(objects[lesion_number - 1], 1, lesions.shape)
+        lesion = lesions[crop] == lesion_number
+
+        volume = np.sum(lesion) * voxelsize  # Assuming same resolution for followup image
+
+        if debug:
+            print("Lesion: " + str(lesion_number))
+            print("Volume [mm^3]: " + str(volume))
+
+        # Check if diff lesion has an hole (i.e., it's enlarging/shrinking)
+        # Right now I'm just taking the diff lesion, fill the holes and check if the enlargment is bigger than (TODO: 5%?) than the filled part
+        # TODO: not sure if it is really necessary to check for this 5% increase, although ...
+        # if we have a mislabeled voxel inside the lesion, we might classify the lesion as enlarging rather than something else
+        # Note that I'm also checking if *the filled lesion* fits the min size criteria
+        # (the padded crop keeps a background shell around the lesion, so filling is identical to the full volume)
+        filled = ndi.binary_fill_holes(lesion)
+        filled_volume = np.sum(filled)
+        if filled_volume - np.sum(lesion) > 0.05 * filled_volume and filled_volume > min_size:
+            if debug:
+                print(hole_label)
+            hole_lesions += 1
+            continue
+
+        if volume <= min_size:
+            if debug:
+                print("Remove lesion, too small")
+            ok_sizes[lesion_number - 1] = False
+            continue
+
+        # Finally, check if we have a new/disappearing solitary lesion or a lesion abutting from another lesion:
+        # 1) has roughly a spheroid shape
+        # 2) if dilated the overlap with other lesions is small (less than max_overlap of its volume)
+        dilated_lesion = binary_dilation(lesion)
+        overlap = np.count_nonzero(np.logical_and(dilated_lesion, reference[crop]))
+        if debug:
+            print("Overlap: " + str(overlap))
+        if np.max(distance_map[crop][lesion]) > 1.1 * voxelsize and overlap < max_overlap * volume:
+            if debug:
+                print(solitary_label)
+            solitary_lesions += 1
+            continue
+
+        # If we are here, we are removing the lesion
+        if debug:
+            print("Remove lesion, it doesn't fit criteria")
+        ok_sizes[lesion_number - 1] = False
+
+    return hole_lesions, solitary_lesions
+
+
+def mask_labels(lesions, ok_sizes):
+    '''
+    This function removes the rejected components of a label map with a single lookup-table remap and
+    renumbers the remaining components consecutively
+
+    :param lesions: label map (output of ndi.label)
+    :param ok_sizes: boolean array (one entry per component) of components to keep
+    :return: return the masked label map in the smallest unsigned integer dtype that fits
+    '''
+    number_of_kept = int(np.sum(ok_sizes))
+    dtype = np.min_scalar_type(number_of_kept)
+    lut = np.zeros(len(ok_sizes) + 1, dtype=dtype)
+    lut[1:][ok_sizes] = np.arange(1, number_of_kept + 1, dtype=dtype)
+    return lut[lesions]
+
+
+def save_label_map(labels, affine, filename, compress_level=6):
+    '''
+    This function writes a label map to a .nii.gz file with the given gzip compression level
+
+    :param labels: label map, stored with its own dtype
+    :param affine: affine of the image
+    :param filename: full path of the output file
+    :param compress_level: gzip compression level (1: fastest, 9: smallest)
+    '''
+    img = nib.Nifti1Image(labels, affine)
+    img.set_data_dtype(labels.dtype)
+    with gzip.open(filename, 'wb', compresslevel=compress_level) as f:
+        img.to_file_map({'image': nib.FileHolder(fileobj=f), 'header': nib.FileHolder(fileobj=f)})
+
+
 # developed by stefano cerri (martinos), adapted to satndalone function by jmcginnis (TUM)
-def generate_samseg_stats(bl_path, fu_path, output_path, min_size=15.0, connectivity=18, max_overlap=0.3, debug=False, save_images=True):
+def generate_samseg_stats(bl_path, fu_path, output_path, min_size=15.0, connectivity=18, max_overlap=0.3, debug=False, save_images=True, compress_level=6, pbvc=None):
     # Minimum voxel size, in mm^3.
     #'Connected component connectivity (26 - 18 - 6).')  # 18 as default as in Commowick2018 (MSSeg challenge)
     #'Maximum overlap between a dilated lesion and another existing lesion to classify it as new/disappearing (in percentage of its volume).')
@@ -46,13 +185,12 @@ def generate_samseg_stats(bl_path, fu_path, output_path, min_size=15.0, connecti
         sys.exit()
 
     # Load baseline
-    baseline = np.array(nib.load(bl_path).get_fdata() == 99, dtype=float)  # Assuming Samseg segmentation 
-    baseline_affine = nib.load(bl_path).affine
+    baseline, baseline_affine = load_lesion_mask(bl_path)  # Assuming Samseg segmentation
     # Compute voxel size
     voxelsize_baseline = np.prod(np.sum(baseline_affine[:3, :3] ** 2, axis=0) ** 0.5)
     voxel_resolution_baseline = np.sum(baseline_affine[:3, :3] ** 2, axis=0) ** 0.5
     # Load follow-up
-    followup = np.array(nib.load(fu_path).get_fdata() == 99, dtype=float) # Assuming Samseg segmentation
+    followup, _ = load_lesion_mask(fu_path)  # Assuming Samseg segmentation
     # First count baseline lesions with connected components
     lesions_baseline, number_of_lesions_baseline = ndi.label(baseline, connectivity)
     # Remove lesions that are smaller than min_size
@@ -74,7 +212,7 @@ def generate_samseg_stats(bl_path, fu_path, output_path, min_size=15.0, connecti
     followup_volume = np.sum(lesion_sizes[ok_sizes_followup])
 
     # Followup - Baseline (i.e., lesion increase)
-    fu_min_bl = np.array(followup - baseline > 0, dtype=float)  
+    fu_min_bl = np.logical_and(followup, np.logical_not(baseline))
     # First count lesions with connected components
     lesions_fu_min_bl, number_of_lesions_fu_min_bl = ndi.label(fu_min_bl, connectivity)
     # Remove lesion that are smaller than min_size
@@ -83,64 +221,19 @@ def generate_samseg_stats(bl_path, fu_path, output_path, min_size=15.0, connecti
     # (avoiding removing ring shape differences which might be smaller than min_size but filled they are not)
     ok_sizes_fu_min_bl = lesion_sizes > 0.7 * min_size
     # Also compute distance_map (euclidean) to decide if new lesion has an acceptable shape
-    distance_map = ndi.distance_transform_edt(lesions_fu_min_bl, sampling=voxel_resolution_baseline)
-    #
-    enlarging_lesions = 0
-    new_lesions = 0
-    for lesion_number in range(1, len(np.unique(lesions_fu_min_bl))):
-        
-        if not ok_sizes_fu_min_bl[lesion_number - 1]:
-            continue
-
-        lesion = lesions_fu_min_bl == lesion_number
-
-        volume = np.sum(lesion) * voxelsize_baseline  # Assuming same resolution for followup image
-
-        if debug:
-            print("Lesion: " + str(lesion_number))
-            print("Volume [mm^3]: " + str(volume))
-
-        # Check if diff lesion has an hole (i.e., it's enlarging)
-        # Right now I'm just taking the diff lesion, fill the holes and check if the enlargment is bigger than (TODO: 5%?) than the filled part
-        # TODO: not sure if it is really necessary to check for this 5% increase, although ...
-        # if we have a mislabeled voxel inside the lesion, we might classify the lesion as enlarging rather than something else
-        # Note that I'm also checking if *the filled lesion* fits the min size criteria 
-        filled = ndi.binary_fill_holes(lesion)
-        filled_volume = np.sum(filled)
-        if filled_volume - np.sum(lesion) > 0.05 * filled_volume and filled_volume > min_size:
-            if debug:
-                print("Enlarging lesion")
-            enlarging_lesions += 1 
-            continue
-
-        if volume <= min_size:
-            if debug:   
-                print("Remove lesion, too small")
-            ok_sizes_fu_min_bl[lesion_number - 1] = False
-            continue
-
-        # Finally, check if we have a new solitary lesion or a lesion abutting from another lesion:
-        # 1) has roughly a spheroid shape
-        # 2) if dilated the overlap with other lesions is small (less than max_overlap of its volume)
-        dilated_lesion = binary_dilation(lesion)
-        overlap = np.sum(np.logical_and(dilated_lesion, baseline) > 0)  
-        if debug:
-            print("Overlap: " + str(overlap))   
-        if np.max(distance_map[lesion]) > 1.1 * voxelsize_baseline and overlap < max_overlap * volume:
-            if debug:
-                print("New solitary or abutting lesion")
-            new_lesions += 1
-            continue
-
-        if debug:
-            print("Remove lesion, it doesn't fit criteria")
-        ok_sizes_fu_min_bl[lesion_number - 1] = False
+    distance_map = ndi.distance_transform_edt(fu_min_bl, sampling=voxel_resolution_baseline)
+    # Classify the components (bounding-box local)
+    enlarging_lesions, new_lesions = classify_difference_lesions(lesions_fu_min_bl, number_of_lesions_fu_min_bl, baseline,
+                                                                 ok_sizes_fu_min_bl, distance_map, voxelsize_baseline,
+                                                                 min_size, max_overlap, debug=debug,
+                                                                 hole_label="Enlarging lesion",
+                                                                 solitary_label="New solitary or abutting lesion")
 
     # Lesion increase volume
     fu_min_bl_volume = np.sum(lesion_sizes[ok_sizes_fu_min_bl])
 
     # Baseline - Followup (i.e., lesion decrease)
-    bl_min_fu = np.array(baseline - followup > 0, dtype=float)
+    bl_min_fu = np.logical_and(baseline, np.logical_not(followup))
     # First count lesions with connected components
     lesions_bl_min_fu, number_of_lesions_bl_min_fu = ndi.label(bl_min_fu, connectivity)
     # Remove lesion that are smaller than min_size
@@ -149,59 +242,13 @@ def generate_samseg_stats(bl_path, fu_path, output_path, min_size=15.0, connecti
     # (avoiding removing ring shape differences which might be smaller than min_size but filled they are not)
     ok_sizes_bl_min_fu = lesion_sizes > 0.7 * min_size
     # Also compute distance_map (euclidean) to decide if disappearing lesion has an acceptable shape
-    distance_map = ndi.distance_transform_edt(lesions_bl_min_fu, sampling=voxel_resolution_baseline)
-    #
-    shrinking_lesions = 0
-    disappearing_lesions = 0
-    for lesion_number in range(1, len(np.unique(lesions_bl_min_fu))):
-        
-        if not ok_sizes_bl_min_fu[lesion_number - 1]:
-            continue
-
-        lesion = lesions_bl_min_fu == lesion_number
-
-        volume = np.sum(lesion) * voxelsize_baseline  # Assuming same resolution for followup image
-
-        if debug:
-            print("Lesion: " + str(lesion_number))
-            print("Volume [mm^3]: " + str(volume))
-
-        # Check if diff lesion has an hole (i.e., it's shrinking)
-        # Right now I'm just taking the diff lesion, fill the holes and check if the enlargment is bigger than (TODO: 5%?) than the filled part
-        # TODO: not sure if it is really necessary to check for this 5% increase, although
-        # if we have a mislabeled voxel inside the lesion, we might classify the lesion as shrinking rather than something else
-        # Note that I'm then checking if *the filled lesion* fits the min size criteria 
-        filled = ndi.binary_fill_holes(lesion)
-        filled_volume = np.sum(filled)
-        if filled_volume - np.sum(lesion) > 0.05 * filled_volume and filled_volume > min_size:
-            if debug:
-                print("Shrinking lesion") 
-            shrinking_lesions += 1
-            continue
-
-        if volume <= min_size:
-            if debug:
-                print("Remove lesion, too small")
-            ok_sizes_bl_min_fu[lesion_number - 1] = False
-            continue
-
-        # Finally, check if we have a disappearing lesion:
-        # 1) has roughly a spheroid shape
-        # 2) if dilated the overlap with other lesions is small (less than max_overlap of its volume)
-        dilated_lesion = binary_dilation(lesion)
-        overlap = np.sum(np.logical_and(dilated_lesion, followup) > 0) 
-        if debug:
-            print("Overlap: " + str(overlap))   
-        if np.max(distance_map[lesion]) > 1.1 * voxelsize_baseline and overlap < max_overlap * volume:
-            if debug:
-                print("Disappearing lesion")
-            disappearing_lesions += 1
-            continue
-
-        # If we are here, we are removing the lesion
-        if debug:     
-            print("Remove lesion, it doesn't fit criteria")
-        ok_sizes_bl_min_fu[lesion_number - 1] = False
+    distance_map = ndi.distance_transform_edt(bl_min_fu, sampling=voxel_resolution_baseline)
+    # Classify the components (bounding-box local)
+    shrinking_lesions, disappearing_lesions = classify_difference_lesions(lesions_bl_min_fu, number_of_lesions_bl_min_fu, followup,
+                                                                          ok_sizes_bl_min_fu, distance_map, voxelsize_baseline,
+                                                                          min_size, max_overlap, debug=debug,
+                                                                          hole_label="Shrinking lesion",
+                                                                          solitary_label="Disappearing lesion")
 
     # Lesion decrease volume
     bl_min_fu_volume = np.sum(lesion_sizes[ok_sizes_bl_min_fu])
@@ -245,36 +292,22 @@ def generate_samseg_stats(bl_path, fu_path, output_path, min_size=15.0, connecti
     lesion_df.loc[1,"fu_min_bl_vol_les"] = fu_min_bl_volume
     lesion_df.loc[1,"bl_min_fu_les"] = disappearing_lesions + shrinking_lesions
     lesion_df.loc[1,"bl_min_fu_vol_les"] = bl_min_fu_volume
+    if pbvc is not None:
+        # PBVC of SIENA, so that the analysis does not have to parse the SIENA reports
+        lesion_df.loc[1,"pbvc"] = pbvc
     lesion_df.to_csv(os.path.join(output_path, subID+"_longi_lesions.csv"), index=False)
 
     if save_images:        
 
-        # Actually mask out small lesions
-        # Baseline
-        for lesion_number in range(1, len(np.unique(lesions_baseline))):
-            if not ok_sizes_baseline[lesion_number - 1]:    
-                lesions_baseline[lesions_baseline == lesion_number] = 0
-        # Followup
-        for lesion_number in range(1, len(np.unique(lesions_followup))):
-            if not ok_sizes_followup[lesion_number - 1]:    
-                lesions_followup[lesions_followup == lesion_number] = 0   
-        # fu - bl
-        for lesion_number in range(1, len(np.unique(lesions_fu_min_bl))):
-            if not ok_sizes_fu_min_bl[lesion_number - 1]:    
-                lesions_fu_min_bl[lesions_fu_min_bl == lesion_number] = 0   
-        # bl - fu
-        for lesion_number in range(1, len(np.unique(lesions_bl_min_fu))):
-            if not ok_sizes_bl_min_fu[lesion_number - 1]:    
-                lesions_bl_min_fu[lesions_bl_min_fu == lesion_number] = 0                                    
-
-        # Save images
-        img = nib.Nifti1Image(lesions_baseline, baseline_affine)
-        nib.save(img, os.path.join(output_path, subID+"_bl_lesions.nii.gz"))
-        img = nib.Nifti1Image(lesions_followup, baseline_affine)
-        nib.save(img, os.path.join(output_path, subID+"_fu_lesions.nii.gz"))
-        img = nib.Nifti1Image(lesions_fu_min_bl, baseline_affine)
-        nib.save(img, os.path.join(output_path, subID+"_fu-min-bl_lesions.nii.gz"))
-        img = nib.Nifti1Image(lesions_bl_min_fu, baseline_affine)
-        nib.save(img, os.path.join(output_path, subID+"_bl-min-fu_lesions.nii.gz"))
+        # Actually mask out small lesions (surviving lesions are renumbered consecutively)
+        # and save images with the smallest integer dtype that fits
+        save_label_map(mask_labels(lesions_baseline, ok_sizes_baseline), baseline_affine,
+                       os.path.join(output_path, subID+"_bl_lesions.nii.gz"), compress_level)
+        save_label_map(mask_labels(lesions_followup, ok_sizes_followup), baseline_affine,
+                       os.path.join(output_path, subID+"_fu_lesions.nii.gz"), compress_level)
+        save_label_map(mask_labels(lesions_fu_min_bl, ok_sizes_fu_min_bl), baseline_affine,
+                       os.path.join(output_path, subID+"_fu-min-bl_lesions.nii.gz"), compress_level)
+        save_label_map(mask_labels(lesions_bl_min_fu, ok_sizes_bl_min_fu), baseline_affine,
+                       os.path.join(output_path, subID+"_bl-min-fu_lesions.nii.gz"), compress_level)
 
     print("Done!")
\ No newline at end of file
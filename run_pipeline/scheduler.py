@@ -0,0 +1,126 @@
+import os
+import json
+import queue
+from collections import deque
+from datetime import datetime
+
+# resource helpers
+# the cohort is processed with a core budget (split into workers x threads per subject) and a memory budget:
+# a new subject is only started if the estimated memory of the running subjects plus the new one fits into the
+# budget and the node currently has enough available memory (observed via /proc/meminfo).
+
+# environment variables limiting the threads of the tools (OpenMP, ITK, BLAS)
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'MKL_NUM_THREADS',
+                    'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def read_meminfo(field):
+    '''
+    :param field: field of /proc/meminfo (e.g. 'MemTotal' or 'MemAvailable')
+    :return: return the value in GB, or None if it can not be read
+    '''
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024 ** 2
+    except OSError:
+        pass
+    return None
+
+
+def plan_resources(cores, memory_gb, memory_per_subject_gb, number_of_workers=None, threads=None):
+    '''
+    This function splits the core budget into parallel subjects (workers) and threads per subject
+
+    :param cores: total number of cores to use
+    :param memory_gb: total memory budget in GB
+    :param memory_per_subject_gb: estimated peak memory of one subject in GB
+    :param number_of_workers: number of parallel subjects (default: derived from the budgets)
+    :param threads: number of threads per subject (default: 4, or cores / number_of_workers)
+    :return: return the number of workers and the number of threads per subject
+    '''
+    if threads is None:
+        threads = max(1, cores // number_of_workers) if number_of_workers else min(4, cores)
+    if number_of_workers is None:
+        number_of_workers = max(1, min(cores // threads, int(memory_gb // memory_per_subject_gb)))
+    return number_of_workers, threads
+
+
+def peak_memory_gb(events_path, run_id):
+    '''
+    This function estimates the peak memory of a subject from its stage events: stages of a subject run concurrently
+    (e.g. siena next to the registrations and SAMSEG), so the peaks of the stages that overlap in time are added up
+
+    :param events_path: path to the .jsonl stage events of a subject (see events.py)
+    :param run_id: identifier of the run
+    :return: return the largest sum of the peak RSS of concurrently running stages of the subject in this run in GB
+             (None if unknown)
+    '''
+    if not os.path.exists(events_path):
+        return None
+    with open(events_path, 'r') as f:
+        events = [e for e in map(json.loads, f) if e.get('run') == run_id and e['status'] == 'done']
+    if not events:
+        return None
+    intervals = []
+    for e in events:
+        start = datetime.fromisoformat(e['start']).timestamp()
+        intervals.append((start, start + e['wall'], e['maxrss_kb']))
+    # the sum is largest at the start of one of the stages
+    peak = max(sum(rss for start, end, rss in intervals if start <= t < end or start == t) for t, _, _ in intervals)
+    return peak / 1024 ** 2
+
+
+def run_admitted(pool, function, dirs, number_of_workers, memory_gb, memory_per_subject_gb, observed_peak=None,
+                 poll_interval=10, claim=None):
+    '''
+    This function submits subjects to the pool one at a time, as long as a worker is free and the memory allows it
+    (estimate: number of running subjects x memory per subject must fit into the budget; observation: the node must
+    currently have at least the memory of one subject available). At least one subject is always running.
+
+    :param pool: multiprocessing pool
+    :param function: function processing one subject folder, returning (subject folder, success, message)
+    :param dirs: list of subject folders
+    :param number_of_workers: maximum number of subjects running at the same time
+    :param memory_gb: memory budget in GB
+    :param memory_per_subject_gb: estimated peak memory of one subject in GB
+    :param observed_peak: function returning the observed peak memory (GB) of a finished subject folder, used to
+                          refine the estimate (optional)
+    :param poll_interval: seconds between two checks of the available memory while subjects are waiting
+    :param claim: function called with a subject folder right before it is submitted, the subject is skipped if it
+                  returns False (e.g. claimed by another pipeline instance, see claims.py)
+    :return: yields the results of the subjects as they finish
+    '''
+    pending = deque(dirs)
+    finished = queue.Queue()
+    running = 0
+    estimate = memory_per_subject_gb
+    observed = []
+
+    def admit():
+        if running == 0:
+            return True
+        available = read_meminfo('MemAvailable')
+        return (running + 1) * estimate <= memory_gb and (available is None or available >= estimate)
+
+    while pending or running:
+        while pending and running < number_of_workers and admit():
+            subject_dir = pending.popleft()
+            if claim is not None and not claim(subject_dir):
+                continue
+            pool.apply_async(function, (subject_dir,), callback=finished.put,
+                             error_callback=lambda e, d=subject_dir: finished.put((d, False, f'{type(e).__name__}: {e}')))
+            running += 1
+        try:
+            result = finished.get(timeout=poll_interval)
+        except queue.Empty:
+            continue
+        running -= 1
+        if observed_peak is not None:
+            peak = observed_peak(result[0])
+            if peak is not None:
+                # use the largest subject peak observed so far (with a safety margin) as estimate
+                observed.append(peak)
+                estimate = 1.2 * max(observed)
+        yield result
@@ -0,0 +1,52 @@
+import json
+import os
+import time
+
+from claims import WorkClaims
+
+# end-to-end tests of --distributed (see claims.py): several pipeline instances share a cohort with the fake toolchain
+
+DERIVATIVES = os.path.join('derivatives', 'samseg-longitudinal-7.3.2')
+
+
+def processed(bids, subject):
+    # number of times the subject was processed (template stages that were run, over all instances)
+    with open(os.path.join(bids, DERIVATIVES, subject, f'{subject}_events.jsonl'), 'r') as f:
+        return sum(e['stage'] == 'template' and e['status'] == 'done' for e in map(json.loads, f))
+
+
+def test_two_instances(bids, pipeline):
+    path = bids(6)
+    # slow enough that both instances are running at the same time
+    env = {'FAKE_RUN_SAMSEG_LONG_DELAY': '1'}
+    # short leases, so an instance waiting for the subjects of the other one polls every two seconds
+    processes = [pipeline(path, '--distributed', 'run1', '--lease-seconds', '8', env=env, wait=False) for _ in range(2)]
+    outputs = [process.communicate(timeout=600)[0] for process in processes]
+    for process, output in zip(processes, outputs):
+        assert process.returncode == 0, output
+    claims = WorkClaims(os.path.join(path, DERIVATIVES, 'claims', 'run1'))
+    owners = set()
+    for i in range(1, 7):
+        subject = f'sub-b{i:04d}'
+        assert processed(path, subject) == 1
+        assert claims.done(subject)['success']
+        owners.add(claims.done(subject)['owner'])
+    assert len(owners) == 2
+    assert not [x for x in os.listdir(claims.claims_dir) if x.endswith('.lease')]
+
+
+def test_expired_lease_is_taken_over(bids, pipeline):
+    path = bids(2)
+    # an instance that claimed sub-b0001 and crashed an hour ago (its lease was not refreshed since)
+    crashed = WorkClaims(os.path.join(path, DERIVATIVES, 'claims', 'run1'), owner='crashed')
+    assert crashed.claim('sub-b0001')
+    lease = os.path.join(crashed.claims_dir, 'sub-b0001.lease')
+    os.utime(lease, (time.time() - 3600, time.time() - 3600))
+
+    output = pipeline(path, '--distributed', 'run1', '--lease-seconds', '20')
+    assert 'took over the expired lease of crashed' in output
+    for subject in ['sub-b0001', 'sub-b0002']:
+        assert processed(path, subject) == 1
+        assert crashed.done(subject)['success']
+        assert crashed.done(subject)['owner'] != 'crashed'
+    assert not os.path.exists(lease)
@@ -0,0 +1,84 @@
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+from runner import ToolRunner
+
+# end-to-end tests of run_pipeline.py with the fake toolchain: success, a failing tool, a hanging tool that runs into
+# its timeout, a retry after a timeout (see fake_toolchain.py for the FAKE_* variables) and the limit of concurrently
+# running tools of a subject
+
+DERIVATIVES = os.path.join('derivatives', 'samseg-longitudinal-7.3.2')
+ALL_STAGES = {'template', 'coreg_0', 'coreg_1', 'vol2vol_0', 'vol2vol_1', 'samseg', 'siena',
+              'fanout_samseg', 'fanout_siena', 'stats', 'cleanup'}
+
+
+def summary(bids):
+    return pd.read_csv(os.path.join(bids, DERIVATIVES, 'pipeline_summary.csv')).set_index('subject')
+
+
+def manifest(bids, subject):
+    with open(os.path.join(bids, DERIVATIVES, subject, f'{subject}_manifest.json'), 'r') as f:
+        return json.load(f)
+
+
+def attempts(bids, subject, stage):
+    with open(os.path.join(bids, DERIVATIVES, subject, 'logs', f'{stage}.log'), 'r') as f:
+        return sum(line.startswith('### ') and ' attempt ' in line for line in f)
+
+
+def test_success(bids, pipeline):
+    path = bids(2)
+    pipeline(path)
+    result = summary(path)
+    assert result['success'].all(), result
+    for subject in result.index:
+        assert set(manifest(path, subject)['stages']) == ALL_STAGES
+        assert os.path.exists(os.path.join(path, DERIVATIVES, subject, f'{subject}_longi_lesions.csv'))
+    # a rerun skips all completed stages (except the cleanup)
+    pipeline(path)
+    assert summary(path)['message'].str.contains('completed stages skipped').all()
+
+
+def test_tool_exit_code(bids, pipeline):
+    path = bids()
+    pipeline(path, env={'FAKE_MRI_COREG_EXIT': '3'})
+    result = summary(path).loc['sub-b0001']
+    assert not result['success']
+    assert 'exit code 3' in result['message']
+    stages = set(manifest(path, 'sub-b0001')['stages'])
+    assert 'template' in stages and not stages & {'coreg_0', 'coreg_1', 'samseg', 'stats'}
+    # an error reported by the tool is not retried
+    assert attempts(path, 'sub-b0001', 'coreg_0') == 1
+
+
+def test_tool_timeout(bids, pipeline):
+    path = bids()
+    pipeline(path, '--timeout', 'siena=1', '--retries', '1', env={'FAKE_SIENA_HANG': '1'})
+    result = summary(path).loc['sub-b0001']
+    assert not result['success']
+    assert 'timed out' in result['message']
+    assert 'siena' not in manifest(path, 'sub-b0001')['stages']
+    assert attempts(path, 'sub-b0001', 'siena') == 2
+
+
+def test_retry_after_timeout(bids, pipeline):
+    path = bids()
+    pipeline(path, '--timeout', 'siena=1', '--retries', '1', env={'FAKE_SIENA_HANG_TIMES': '1'})
+    assert summary(path).loc['sub-b0001', 'success']
+    assert set(manifest(path, 'sub-b0001')['stages']) == ALL_STAGES
+    assert attempts(path, 'sub-b0001', 'siena') == 2
+
+
+def test_tools_per_subject(tmp_path):
+    # stages of a subject that are ready at the same time only run max_tools tools at once
+    command = [sys.executable, '-c', 'import time; time.sleep(1)']
+    for max_tools, minimum, maximum in [(1, 3, 10), (3, 1, 2.5)]:
+        runner = ToolRunner(dict(os.environ), str(tmp_path / f'logs{max_tools}'), max_tools=max_tools)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(3) as executor:
+            list(executor.map(lambda i: runner.run(f'coreg_{i}', command, cwd=str(tmp_path)), range(3)))
+        assert minimum <= time.perf_counter() - start < maximum
@@ -0,0 +1,206 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+# content-addressed cache of tool outputs
+# the outputs of deterministic tools (mri_robust_template, mri_coreg, mri_vol2vol) are stored under a key that is the
+# sha256 of the tool, its version, its arguments and the content of its input files. Input and output paths in the
+# arguments are replaced by placeholders, so a rerun of the same subject (e.g. with other SAMSEG flags, in another
+# derivatives or scratch folder) finds the entry. On a hit, the outputs are hardlinked (or copied) from the cache.
+# Every entry is a folder <root>/<key[:2]>/<key> with the output files and entry.json; the mtime of entry.json is the
+# time of the last use, the least recently used entries are removed when the cache exceeds its size.
+
+HASH_BUFFER_SIZE = 16 * 1024 ** 2
+
+
+def file_hash(path):
+    '''
+    :param path: path to a file
+    :return: return the sha256 of the file as hex string
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(HASH_BUFFER_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # other file system or no hardlinks (e.g. some network file systems)
+        shutil.copy2(src, dst)
+
+
+class ToolCache:
+    '''
+    Content-addressed cache of tool outputs with a size limit (least recently used entries are removed)
+    '''
+
+    def __init__(self, root, max_size_gb=None):
+        '''
+        :param root: cache folder (can be shared by several runs and nodes)
+        :param max_size_gb: size limit of the cache in GB (default: no limit)
+        '''
+        self.root = root
+        self.max_size_gb = max_size_gb
+        self._hashes = {}
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _input_hash(self, path):
+        # inputs are hashed once per process (as long as size and mtime do not change)
+        st = os.stat(path)
+        signature = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        with self._lock:
+            if signature in self._hashes:
+                return self._hashes[signature]
+        digest = file_hash(path)
+        with self._lock:
+            self._hashes[signature] = digest
+        return digest
+
+    def key(self, args, inputs, outputs, version, cwd=''):
+        '''
+        :param args: command as list of arguments
+        :param inputs: input files of the command (paths as in args)
+        :param outputs: output files of the command (paths as in args)
+        :param version: version of the tool
+        :param cwd: working directory of the command (for relative paths)
+        :return: return the cache key of the command
+        '''
+        placeholders = {x: f'<input {i}>' for i, x in enumerate(inputs)}
+        placeholders.update({x: f'<output {i}>' for i, x in enumerate(outputs)})
+        description = {'tool': os.path.basename(args[0]), 'version': version,
+                       'args': [placeholders.get(x, x) for x in args[1:]],
+                       'inputs': [self._input_hash(os.path.join(cwd, x)) for x in inputs]}
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def restore(self, key, outputs):
+        '''
+        This function hardlinks (or copies) the outputs of a cached command to their paths
+
+        :param key: cache key (see key)
+        :param outputs: paths the outputs are restored to (same order as when they were stored)
+        :return: return True on a cache hit
+        '''
+        entry = self._entry(key)
+        try:
+            for i, path in enumerate(outputs):
+                if os.path.exists(path):
+                    os.remove(path)
+                _link_or_copy(os.path.join(entry, str(i)), path)
+            # the mtime of entry.json is the time of the last use
+            os.utime(os.path.join(entry, 'entry.json'))
+        except OSError:
+            # missing (or evicted while being restored)
+            for path in outputs:
+                if os.path.exists(path):
+                    os.remove(path)
+            return False
+        return True
+
+    def store(self, key, outputs, description=None):
+        '''
+        This function adds the outputs of a command to the cache (the entry is written to a temporary folder and
+        renamed, so concurrent runs never see an incomplete entry) and removes the least recently used entries if
+        the cache is too large
+
+        :param key: cache key (see key)
+        :param outputs: paths of the outputs of the command
+        :param description: information about the command stored with the entry (e.g. tool and arguments)
+        '''
+        entry = self._entry(key)
+        if os.path.exists(entry):
+            return
+        tmp = os.path.join(self.root, f'.tmp-{uuid.uuid4().hex}')
+        os.makedirs(tmp)
+        try:
+            for i, path in enumerate(outputs):
+                _link_or_copy(path, os.path.join(tmp, str(i)))
+            size = sum(os.path.getsize(x) for x in outputs)
+            with open(os.path.join(tmp, 'entry.json'), 'w') as f:
+                json.dump({'size': size, 'outputs': [os.path.basename(x) for x in outputs],
+                           'created': time.time(), **(description or {})}, f)
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            os.rename(tmp, entry)
+        except OSError:
+            # stored by another run in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        if self.max_size_gb is not None:
+            self.prune(self.max_size_gb)
+
+    def entries(self):
+        '''
+        :return: return a list of (last use, size in bytes, path) of all entries
+        '''
+        entries = []
+        for prefix in os.listdir(self.root):
+            if prefix.startswith('.'):
+                continue
+            for key in os.listdir(os.path.join(self.root, prefix)):
+                entry = os.path.join(self.root, prefix, key)
+                try:
+                    with open(os.path.join(entry, 'entry.json'), 'r') as f:
+                        size = json.load(f)['size']
+                    entries.append((os.path.getmtime(os.path.join(entry, 'entry.json')), size, entry))
+                except (OSError, ValueError, KeyError):
+                    # incomplete or corrupt entry, removed first
+                    entries.append((0, 0, entry))
+        return entries
+
+    def prune(self, max_size_gb=0, max_age_days=None):
+        '''
+        This function removes the least recently used entries until the cache fits into max_size_gb
+
+        :param max_size_gb: size limit in GB (0: remove all entries)
+        :param max_age_days: also remove the entries that were not used for this many days
+        :return: return the number of removed entries and their size in bytes
+        '''
+        # temporary folders of stores that were interrupted more than a day ago
+        for name in os.listdir(self.root):
+            if name.startswith('.tmp-') and time.time() - os.path.getmtime(os.path.join(self.root, name)) > 86400:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+        entries = sorted(self.entries())
+        size = sum(x[1] for x in entries)
+        removed = [0, 0]
+        for last_use, entry_size, entry in entries:
+            if size <= max_size_gb * 1024 ** 3 and (max_age_days is None or time.time() - last_use <= max_age_days * 86400):
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            size -= entry_size
+            removed[0] += 1
+            removed[1] += entry_size
+        return tuple(removed)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Show or prune the tool output cache of run_pipeline.py.')
+    parser.add_argument('cache_dir', help='Cache folder (--cache-dir of run_pipeline.py).')
+    parser.add_argument('--max_size_gb', help='Remove the least recently used entries until the cache fits.', type=float, default=None)
+    parser.add_argument('--max_age_days', help='Remove the entries that were not used for this many days.', type=float, default=None)
+    parser.add_argument('--clear', action='store_true', help='Remove all entries.')
+
+    args = parser.parse_args()
+
+    cache = ToolCache(args.cache_dir)
+    entries = cache.entries()
+    print(f'{len(entries)} entries, {sum(x[1] for x in entries) / 1024 ** 3:.2f} GB')
+    if args.clear or args.max_size_gb is not None or args.max_age_days is not None:
+        max_size_gb = 0 if args.clear else args.max_size_gb if args.max_size_gb is not None else float('inf')
+        number, size = cache.prune(max_size_gb, args.max_age_days)
+        print(f'removed {number} entries, {size / 1024 ** 3:.2f} GB')
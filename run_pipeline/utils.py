@@ -1,8 +1,10 @@
 import os
+import csv
 import shutil
+import socket
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 import re
-from bs4 import BeautifulSoup
 import numpy as np
 
 # bids helpers
@@ -35,46 +37,207 @@ def getSessionID(path):
     return found
 
 # multiprocessing helpers
-def split_list(alist, splits=1):
-    length = len(alist)
-    return [alist[i * length // splits: (i + 1) * length // splits]
-            for i in range(splits)]
+def write_summary(results, filename):
+    '''
+    This function prints a per-subject success/failure summary of a pipeline run and writes it to a .csv file
+
+    :param results: list of (subject folder, success flag, status message) tuples as returned by the workers
+    :param filename: full path of the summary .csv file
+    '''
+    results = sorted(results)
+    failed = [r for r in results if not r[1]]
+    # written to a temporary file and renamed (several pipeline instances may write the summary, see claims.py)
+    tmp = f'{filename}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['subject', 'success', 'message'])
+        for subject_dir, success, message in results:
+            writer.writerow([os.path.basename(subject_dir), success, message])
+    os.replace(tmp, filename)
+    print(f'{len(results) - len(failed)}/{len(results)} subjects processed successfully.')
+    for subject_dir, _, message in failed:
+        print(f'  failed: {os.path.basename(subject_dir)} ({message})')
+    print(f'summary written to {filename}')
+
+
+def run_stage_graph(stages, max_workers=None, on_failure=None):
+    '''
+    This function runs a small dependency graph of processing stages. A stage is started as soon as all the stages
+    it depends on have finished. Stages run in threads, as the heavy lifting is done by external tools.
+
+    :param stages: dictionary mapping a stage name to a tuple (function, list of names of the stages it depends on)
+    :param max_workers: maximum number of concurrently running stages (default: number of stages)
+    :param on_failure: function called with the exception of the first failing stage (e.g. to abort running stages)
+    :return: return the list of stage names in the order in which they finished
+    '''
+    for name, (_, dependencies) in stages.items():
+        for dependency in dependencies:
+            if dependency not in stages:
+                raise ValueError(f'stage {name} depends on unknown stage {dependency}')
+
+    finished = []
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(stages)) as executor:
+        while len(finished) < len(stages):
+            # submit all stages whose dependencies are fulfilled
+            for name, (function, dependencies) in stages.items():
+                if name not in finished and name not in running.values() and all(d in finished for d in dependencies):
+                    running[executor.submit(function)] = name
+            if not running:
+                raise ValueError(f'cyclic stage dependencies: {sorted(set(stages) - set(finished))}')
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    # stages that were not started yet are skipped, the exception of the failed stage is re-raised
+                    if on_failure is not None:
+                        on_failure(future.exception())
+                    raise future.exception()
+                finished.append(name)
+    return finished
+
+
+def prefetch(tasks, max_workers=16):
+    '''
+    This function runs all reading tasks in a bounded thread pool, so that the reads are issued concurrently
+    (on network file systems the latency per file, not the parsing, dominates). Errors are returned instead of
+    raised, so that one missing or corrupt file does not stop the caller.
+
+    :param tasks: list of tuples (function, *arguments)
+    :param max_workers: maximum number of files read at the same time
+    :return: yields a tuple (result, error message or None) per task, in the order of the tasks
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(*task) for task in tasks]
+        for future in futures:
+            try:
+                yield future.result(), None
+            except Exception as e:
+                yield None, f'{type(e).__name__}: {e}'
 
 
 # path helpers
-def MoveandCheck(orig, target):
-    '''
-    This function tries to move a file with current path "orig" to a target path "target" and 
-    checks if the orig file exists and if it was copied successfully to target
-    :param orig: full path of original location (with (original) filename in the path)
-    :param target: full path of target location (with (new) filename in the path)
-    '''
-    if os.path.exists(orig):
-        shutil.move(orig, target)
-        if not os.path.exists(target):
-            raise ValueError(f'failed to move {orig}')
-        else:
-            print(f'successfully copied {os.path.basename(orig)} to {os.path.basename(target)} target location')
+def _transfer(orig, target, copy):
+    if not copy:
+        try:
+            # same file system: a rename, no data is copied
+            os.rename(orig, target)
+            return
+        except OSError:
+            pass
+    # other file system (e.g. node-local scratch to the shared volume): copy to a temporary file and rename it,
+    # so the target is never incomplete
+    if os.path.isdir(orig):
+        shutil.copytree(orig, target + '.tmp')
     else:
-        raise Warning(f'file {os.path.basename(orig)} does not exist in original folder!')
+        shutil.copy2(orig, target + '.tmp')
+    os.replace(target + '.tmp', target)
+    if not copy:
+        shutil.rmtree(orig) if os.path.isdir(orig) else os.remove(orig)
+
 
+def move_files(pairs, copy=False, max_workers=8):
+    '''
+    This function moves (or copies) many files in one pass: the files are renamed if source and target are on the same
+    file system and copied by several threads otherwise. Instead of checking every file, the source and target folders
+    are listed once before and after the transfer.
 
-def getSegList(path):
+    :param pairs: list of (original path, target path) tuples
+    :param copy: copy the files instead of moving them
+    :param max_workers: number of files copied at the same time (across file systems)
+    :return: return the total size of the files in bytes
     '''
-    This function lists all "*_seg.mgz"-files that are in the given path. 
+    def listing(folders):
+        sizes = {}
+        for folder in folders:
+            with os.scandir(folder or '.') as entries:
+                # folders (e.g. of SAMSEG) are only checked for existence
+                sizes.update({os.path.join(folder, entry.name): entry.stat().st_size if entry.is_file() else -1
+                              for entry in entries})
+        return sizes
+
+    if not pairs:
+        return 0
+    pairs = [(os.path.normpath(orig), os.path.normpath(target)) for orig, target in pairs]
+    sources = listing({os.path.dirname(orig) for orig, _ in pairs})
+    missing = [orig for orig, _ in pairs if orig not in sources]
+    if missing:
+        raise Warning(f'{len(missing)} file(s) do not exist in original folder: {", ".join(os.path.basename(x) for x in missing)}')
+    targets = {os.path.dirname(target) for _, target in pairs}
+    for folder in targets:
+        Path(folder).mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda x: _transfer(x[0], x[1], copy), pairs))
+    # verify all targets with one listing per target folder
+    moved = listing(targets)
+    failed = [orig for orig, target in pairs if moved.get(target) != sources[orig]]
+    if failed:
+        raise ValueError(f'failed to {"copy" if copy else "move"} {", ".join(failed)}')
+    return sum(max(sources[orig], 0) for orig, _ in pairs)
 
-    :param path: path to BIDS derviatives database
-    :return: return the lists of "*_seg.mgz"-files.
+
+# PBVC reported by SIENA, e.g. "finalPBVC -0.512" in report.siena and "<b>... PBVC: -0.512 </b>" in report.html
+_SIENA_PBVC = re.compile(r'^finalPBVC\s+(\S+)', re.MULTILINE)
+_HTML_PBVC = re.compile(r'<b>[^<]*PBVC[^<:]*:\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*<')
+
+
+def parse_pbvc_from_siena(filename):
     '''
-    seg_ls = sorted(list(Path(path).rglob('*_seg.mgz')))
-    return seg_ls
+    :param filename: path to the plain-text SIENA report (report.siena)
+    :return: return the PBVC value (from the "finalPBVC" line)
+    '''
+    with open(filename, 'r') as f:
+        match = _SIENA_PBVC.search(f.read())
+    if match is None:
+        raise ValueError(f'no "finalPBVC" line in {filename}')
+    try:
+        return float(match.group(1))
+    except ValueError:
+        raise ValueError(f'invalid PBVC value "{match.group(1)}" in {filename}') from None
+
 
 def parse_pbvc_from_html_fsl(filename):
-    with open(filename,'r') as f:
-        html_content = f.read()
-    soup = BeautifulSoup(html_content, 'html.parser')
-    pbvc_text = str(soup.find_all('b')[5])
-    assert "PBVC" in pbvc_text, 'Cannot extract pbvc from report.html, naming convention changed!'
-    number = pbvc_text.split(':')[1]
-    pbvc_value = float(number.split('<')[0])
-    return pbvc_value
+    '''
+    :param filename: path to the SIENA html report (report.html)
+    :return: return the PBVC value (from the first bold "PBVC: <value>" entry)
+    '''
+    with open(filename, 'r') as f:
+        match = _HTML_PBVC.search(f.read())
+    if match is None:
+        raise ValueError(f'no PBVC value in {filename}, naming convention of the SIENA report changed?')
+    return float(match.group(1))
+
+
+def parse_pbvc(html_filename, siena_filename=None):
+    '''
+    This function reads the PBVC from the plain-text SIENA report if it exists, otherwise from the html report
+
+    :param html_filename: path to the SIENA html report
+    :param siena_filename: path to the plain-text SIENA report (optional)
+    :return: return the PBVC value
+    '''
+    if siena_filename is not None and os.path.exists(siena_filename):
+        return parse_pbvc_from_siena(siena_filename)
+    return parse_pbvc_from_html_fsl(html_filename)
+
+def parse_stats(filename):
+    '''
+    This function reads a SAMSEG stats file (e.g. _samseg.stats or _sbtiv.stats) with lines of the format
+    "# Measure <ROI>, <volume>, <unit>"
+
+    :param filename: path to the stats file
+    :return: return a dictionary mapping the ROI names to their volumes
+    '''
+    volumes = {}
+    with open(filename, 'r') as f:
+        for i, line in enumerate(f, 1):
+            if not line.startswith('# Measure '):
+                continue
+            try:
+                roi, volume, _ = line[len('# Measure '):].split(',')
+                volumes[roi] = float(volume)
+            except ValueError:
+                raise ValueError(f'{filename}, line {i}: cannot parse "{line.strip()}"') from None
+    if not volumes:
+        raise ValueError(f'{filename} contains no "# Measure" lines')
+    return volumes